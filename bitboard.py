@@ -0,0 +1,192 @@
+PIECE_CODES = ('wp', 'wn', 'wb', 'wr', 'wq', 'wk', 'bp', 'bn', 'bb', 'br', 'bq', 'bk')
+
+# Squares are numbered like the list board: index = row * 8 + col, so a8 is 0 and h1 is 63.
+NORTH, SOUTH, EAST, WEST = (-1, 0), (1, 0), (0, 1), (0, -1)
+NORTH_EAST, NORTH_WEST, SOUTH_EAST, SOUTH_WEST = (-1, 1), (-1, -1), (1, 1), (1, -1)
+ORTHOGONAL_DIRECTIONS = (NORTH, SOUTH, EAST, WEST)
+DIAGONAL_DIRECTIONS = (NORTH_EAST, NORTH_WEST, SOUTH_EAST, SOUTH_WEST)
+
+ALL_SQUARES = (1 << 64) - 1
+FILE_A = sum(1 << (r * 8) for r in range(8))
+FILE_H = FILE_A << 7
+ROWS = [0xFF << (r * 8) for r in range(8)]
+# (row, col) of every square, so generated moves need no divmod.
+SQUARES = [divmod(sq, 8) for sq in range(64)]
+
+
+def square_index(r, c):
+    return r * 8 + c
+
+
+def iter_squares(bitboard):
+    while bitboard:
+        low_bit = bitboard & -bitboard
+        yield low_bit.bit_length() - 1
+        bitboard ^= low_bit
+
+
+def _offset_table(offsets):
+    table = []
+    for sq in range(64):
+        r, c = divmod(sq, 8)
+        mask = 0
+        for dr, dc in offsets:
+            if 0 <= r + dr < 8 and 0 <= c + dc < 8:
+                mask |= 1 << square_index(r + dr, c + dc)
+        table.append(mask)
+    return table
+
+
+def _ray_table(direction):
+    dr, dc = direction
+    table = []
+    for sq in range(64):
+        r, c = divmod(sq, 8)
+        mask = 0
+        for i in range(1, 8):
+            if not (0 <= r + dr * i < 8 and 0 <= c + dc * i < 8):
+                break
+            mask |= 1 << square_index(r + dr * i, c + dc * i)
+        table.append(mask)
+    return table
+
+
+KNIGHT_ATTACKS = _offset_table(((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)))
+KING_ATTACKS = _offset_table(ORTHOGONAL_DIRECTIONS + DIAGONAL_DIRECTIONS)
+PAWN_ATTACKS = {'w': _offset_table((NORTH_EAST, NORTH_WEST)), 'b': _offset_table((SOUTH_EAST, SOUTH_WEST))}
+RAYS = {direction: _ray_table(direction) for direction in ORTHOGONAL_DIRECTIONS + DIAGONAL_DIRECTIONS}
+# Rays that run towards higher square indices find their first blocker with the lowest set bit.
+_INCREASING = {SOUTH, EAST, SOUTH_EAST, SOUTH_WEST}
+
+
+def _between_table():
+    # Squares strictly between two squares on a shared line, 0 when they share none.
+    table = [[0] * 64 for _ in range(64)]
+    for direction, rays in RAYS.items():
+        for sq in range(64):
+            for target in iter_squares(rays[sq]):
+                table[sq][target] = rays[sq] ^ rays[target] ^ (1 << target)
+    return table
+
+
+BETWEEN = _between_table()
+
+
+def _first_blocker(direction, blockers):
+    if direction in _INCREASING:
+        return (blockers & -blockers).bit_length() - 1
+    return blockers.bit_length() - 1
+
+
+# (ray table, runs towards higher indices) per direction, looked up once rather than per call.
+_ORTHOGONAL_RAYS = [(RAYS[direction], direction in _INCREASING) for direction in ORTHOGONAL_DIRECTIONS]
+_DIAGONAL_RAYS = [(RAYS[direction], direction in _INCREASING) for direction in DIAGONAL_DIRECTIONS]
+
+
+def _slider_attacks(sq, occupied, rays):
+    attacks = 0
+    for table, increasing in rays:
+        ray = table[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= table[(blockers & -blockers).bit_length() - 1 if increasing else blockers.bit_length() - 1]
+        attacks |= ray
+    return attacks
+
+
+def rook_attacks(sq, occupied):
+    return _slider_attacks(sq, occupied, _ORTHOGONAL_RAYS)
+
+
+def bishop_attacks(sq, occupied):
+    return _slider_attacks(sq, occupied, _DIAGONAL_RAYS)
+
+
+def queen_attacks(sq, occupied):
+    return _slider_attacks(sq, occupied, _ORTHOGONAL_RAYS) | _slider_attacks(sq, occupied, _DIAGONAL_RAYS)
+
+
+class BitboardPosition:
+    """Piece placement as one 64-bit integer per piece code.
+
+    It is kept next to the list board rather than replacing it, so code written
+    against the list board (the visualizer, the evaluator) reads that unchanged,
+    while move generation and attack queries work on whole sets of squares.
+    """
+
+    def __init__(self, rows):
+        self.bitboards = {piece: 0 for piece in PIECE_CODES}
+        self.occupancy = {'w': 0, 'b': 0}
+        for r, row in enumerate(rows):
+            for c, piece in enumerate(row):
+                if piece != '--':
+                    self.toggle(piece, r, c)
+
+    def toggle(self, piece, r, c):
+        # Adds the piece to an empty square or removes it from its own; make and undo call it in pairs.
+        bit = 1 << (r * 8 + c)
+        self.bitboards[piece] ^= bit
+        self.occupancy[piece[0]] ^= bit
+
+    @property
+    def occupied(self):
+        return self.occupancy['w'] | self.occupancy['b']
+
+    def attackers(self, sq, attacker_color, occupied):
+        """Squares of attacker_color pieces attacking sq, with sliders blocked by occupied."""
+        bitboards = self.bitboards
+        queens = bitboards[attacker_color + 'q']
+        # A pawn attacks sq exactly when a pawn of the other color on sq would attack it back.
+        return (KNIGHT_ATTACKS[sq] & bitboards[attacker_color + 'n']) | \
+            (KING_ATTACKS[sq] & bitboards[attacker_color + 'k']) | \
+            (PAWN_ATTACKS['b' if attacker_color == 'w' else 'w'][sq] & bitboards[attacker_color + 'p']) | \
+            (rook_attacks(sq, occupied) & (bitboards[attacker_color + 'r'] | queens)) | \
+            (bishop_attacks(sq, occupied) & (bitboards[attacker_color + 'b'] | queens))
+
+    def is_attacked(self, sq, attacker_color, occupied=None):
+        bitboards = self.bitboards
+        if KNIGHT_ATTACKS[sq] & bitboards[attacker_color + 'n']:
+            return True
+        if KING_ATTACKS[sq] & bitboards[attacker_color + 'k']:
+            return True
+        if PAWN_ATTACKS['b' if attacker_color == 'w' else 'w'][sq] & bitboards[attacker_color + 'p']:
+            return True
+        if occupied is None:
+            occupied = self.occupied
+        queens = bitboards[attacker_color + 'q']
+        rooks = bitboards[attacker_color + 'r'] | queens
+        if rooks and rook_attacks(sq, occupied) & rooks:
+            return True
+        bishops = bitboards[attacker_color + 'b'] | queens
+        if bishops and bishop_attacks(sq, occupied) & bishops:
+            return True
+        return False
+
+    def pins(self, king_sq, ally_color, enemy_color, occupied):
+        """Returns {square: line} for each ally piece pinned to the king on king_sq.
+
+        The line holds the squares the pinned piece may still move to: those between
+        the king and the pinner, and the pinner itself.
+        """
+        bitboards = self.bitboards
+        queens = bitboards[enemy_color + 'q']
+        allies = self.occupancy[ally_color]
+        pin_lines = {}
+        for directions, sliders in ((ORTHOGONAL_DIRECTIONS, bitboards[enemy_color + 'r'] | queens),
+                                    (DIAGONAL_DIRECTIONS, bitboards[enemy_color + 'b'] | queens)):
+            if not sliders:
+                continue
+            for direction in directions:
+                ray = RAYS[direction][king_sq]
+                if not ray & sliders:
+                    continue
+                first = _first_blocker(direction, ray & occupied)
+                if not (allies >> first) & 1:
+                    continue
+                beyond = RAYS[direction][first] & occupied
+                if not beyond:
+                    continue
+                pinner = _first_blocker(direction, beyond)
+                if (sliders >> pinner) & 1:
+                    pin_lines[first] = ray ^ RAYS[direction][pinner]
+        return pin_lines
@@ -1,8 +1,66 @@
-from copy import deepcopy
-from collections import Counter
+import random
+from bitboard import (PIECE_CODES, ALL_SQUARES, BETWEEN, FILE_A, FILE_H, KING_ATTACKS, KNIGHT_ATTACKS, PAWN_ATTACKS,
+                      ROWS, SQUARES, BitboardPosition, bishop_attacks, iter_squares, queen_attacks, rook_attacks,
+                      square_index)
+
+WHITE_PIECE_CODES = tuple(piece for piece in PIECE_CODES if piece[0] == 'w')
+BLACK_PIECE_CODES = tuple(piece for piece in PIECE_CODES if piece[0] == 'b')
+
+# Fixed seed so position keys are reproducible between runs and processes.
+_zobrist_random = random.Random(0x5EED)
+ZOBRIST_PIECES = {piece: [[_zobrist_random.getrandbits(64) for _ in range(8)] for _ in range(8)]
+                  for piece in PIECE_CODES}
+ZOBRIST_BLACK_TO_MOVE = _zobrist_random.getrandbits(64)
+ZOBRIST_CASTLING = [_zobrist_random.getrandbits(64) for _ in range(16)]
+ZOBRIST_EN_PASSANT = [_zobrist_random.getrandbits(64) for _ in range(8)]
+
+PROMOTION_PIECES = ('q', 'r', 'b', 'n')
+
+# Coarse piece values for MVV-LVA ordering; a king capturing sorts after every other attacker.
+MVV_LVA_VALUES = {'p': 1, 'n': 3, 'b': 3, 'r': 5, 'q': 9, 'k': 10}
+
+# Centipawn values for static exchange evaluation.
+SEE_VALUES = {'p': 100, 'n': 320, 'b': 330, 'r': 500, 'q': 900, 'k': 20000}
+
+STARTING_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+CASTLE_WKS = 1
+CASTLE_WQS = 2
+CASTLE_BKS = 4
+CASTLE_BQS = 8
+CASTLE_ALL = CASTLE_WKS | CASTLE_WQS | CASTLE_BKS | CASTLE_BQS
+
+# Rights that survive a move touching a square: any move from or to a king or rook home square clears them.
+CASTLE_MASK = [[CASTLE_ALL] * 8 for _ in range(8)]
+CASTLE_MASK[7][4] = CASTLE_ALL & ~(CASTLE_WKS | CASTLE_WQS)
+CASTLE_MASK[7][7] = CASTLE_ALL & ~CASTLE_WKS
+CASTLE_MASK[7][0] = CASTLE_ALL & ~CASTLE_WQS
+CASTLE_MASK[0][4] = CASTLE_ALL & ~(CASTLE_BKS | CASTLE_BQS)
+CASTLE_MASK[0][7] = CASTLE_ALL & ~CASTLE_BKS
+CASTLE_MASK[0][0] = CASTLE_ALL & ~CASTLE_BQS
+
+
+def _on_board_targets(offsets):
+    return [[[(r + dr, c + dc) for dr, dc in offsets if 0 <= r + dr < 8 and 0 <= c + dc < 8]
+             for c in range(8)] for r in range(8)]
+
+
+def _rays(directions):
+    return [[[[(r + dr * i, c + dc * i) for i in range(1, 8) if 0 <= r + dr * i < 8 and 0 <= c + dc * i < 8]
+              for dr, dc in directions] for c in range(8)] for r in range(8)]
+
+
+# Per-square target lists so attack queries never bounds-check or build Move objects.
+KNIGHT_TARGETS = _on_board_targets(((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)))
+KING_TARGETS = _on_board_targets(((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)))
+ORTHOGONAL_RAYS = _rays(((1, 0), (-1, 0), (0, 1), (0, -1)))
+DIAGONAL_RAYS = _rays(((1, 1), (1, -1), (-1, 1), (-1, -1)))
 
 class GameState:
-    def __init__(self, player_wants_black=False):
+    def __init__(self, player_wants_black=False, backend='list'):
+        if backend not in ('list', 'bitboard'):
+            raise ValueError(f"Unknown board backend: {backend}")
+        self.backend = backend
         self.board = [
             ['br', 'bn', 'bb', 'bq', 'bk', 'bb', 'bn', 'br'],
             ['bp', 'bp', 'bp', 'bp', 'bp', 'bp', 'bp', 'bp'],
@@ -13,6 +71,8 @@ class GameState:
             ['wp', 'wp', 'wp', 'wp', 'wp', 'wp', 'wp', 'wp'],
             ['wr', 'wn', 'wb', 'wq', 'wk', 'wb', 'wn', 'wr']
         ]
+        # Kept alongside the list board with the 'bitboard' backend, which generates moves from it.
+        self.bitboard_position = BitboardPosition(self.board) if backend == 'bitboard' else None
 
         self.move_functions = {'p': self.get_pawn_moves, 'r': self.get_rook_moves, 'n': self.get_knight_moves,
                               'b': self.get_bishop_moves, 'q': self.get_queen_moves, 'k': self.get_king_moves}
@@ -27,19 +87,166 @@ class GameState:
         self.checkmate = False
         self.stalemate = False
         self.en_passant_possible = ()
-        self.en_passant_log = [self.en_passant_possible]
+        self.castle_rights = CASTLE_ALL
+        self.piece_squares = self._collect_piece_squares()
+        self.halfmove_clock = 0
+        self.fullmove_number = 1
+        self.zobrist_key = self._compute_zobrist_key()
+        # One (castle_rights, en_passant_possible, piece_captured, zobrist_key, halfmove_clock) record per move made.
+        self.undo_stack = []
+        # (zobrist_key, moves, in_check, checkmate, stalemate) from the last get_valid_moves call.
+        self.valid_moves_cache = None
+
+        self.position_history = {}
+        self._update_position_history()
 
-        self.castle_rights = CastleRights(True, True, True, True)
-        self.castle_rights_log = [deepcopy(self.castle_rights)]
+    @classmethod
+    def from_fen(cls, fen, player_wants_black=False, backend='list'):
+        game = cls(player_wants_black=player_wants_black, backend=backend)
+        game.load_fen(fen)
+        return game
+
+    def to_snapshot(self):
+        # Picklable copy of the position for another process: FEN plus repetition counts.
+        return self.to_fen(), dict(self.position_history), self.player_wants_black, self.backend
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        fen, position_history, player_wants_black, backend = snapshot
+        game = cls.from_fen(fen, player_wants_black=player_wants_black, backend=backend)
+        game.position_history = dict(position_history)
+        return game
+
+    def load_fen(self, fen):
+        fields = fen.split()
+        if len(fields) < 4:
+            raise ValueError(f"FEN needs at least 4 fields: {fen!r}")
+        placement, side, castling, en_passant = fields[:4]
+
+        rows = placement.split('/')
+        if len(rows) != 8:
+            raise ValueError(f"FEN board must have 8 ranks: {fen!r}")
+        board = []
+        for rank in rows:
+            row = []
+            for char in rank:
+                if char.isdigit():
+                    row.extend(['--'] * int(char))
+                elif char.lower() in 'pnbrqk':
+                    row.append(('w' if char.isupper() else 'b') + char.lower())
+                else:
+                    raise ValueError(f"Invalid piece {char!r} in FEN: {fen!r}")
+            if len(row) != 8:
+                raise ValueError(f"FEN rank {rank!r} does not have 8 squares")
+            board.append(row)
+        kings = {piece: (r, c) for r, row in enumerate(board) for c, piece in enumerate(row) if piece[1] == 'k'}
+        if 'wk' not in kings or 'bk' not in kings:
+            raise ValueError(f"FEN must place both kings: {fen!r}")
+        if side not in ('w', 'b'):
+            raise ValueError(f"Invalid side to move {side!r} in FEN")
+        if castling != '-' and any(char not in 'KQkq' for char in castling):
+            raise ValueError(f"Invalid castling field {castling!r} in FEN")
+        # The square behind a pawn that just moved two: rank 6 when white is to move, rank 3 when black is.
+        if en_passant != '-' and (len(en_passant) != 2 or en_passant[0] not in Move.files_to_cols
+                                  or en_passant[1] != ('6' if side == 'w' else '3')):
+            raise ValueError(f"Invalid en passant square {en_passant!r} in FEN")
+
+        self.board = board
+        self.bitboard_position = BitboardPosition(board) if self.backend == 'bitboard' else None
+        self.white_king_location = kings['wk']
+        self.black_king_location = kings['bk']
+        self.white_to_move = side == 'w'
+        self.castle_rights = 0
+        # A right only counts while its king and rook are still on their home squares.
+        for char, right, row, rook_col in (('K', CASTLE_WKS, 7, 7), ('Q', CASTLE_WQS, 7, 0),
+                                           ('k', CASTLE_BKS, 0, 7), ('q', CASTLE_BQS, 0, 0)):
+            color = 'w' if row == 7 else 'b'
+            if char in castling and board[row][4] == color + 'k' and board[row][rook_col] == color + 'r':
+                self.castle_rights |= right
+        if en_passant == '-':
+            self.en_passant_possible = ()
+        else:
+            self.en_passant_possible = (Move.ranks_to_rows[en_passant[1]], Move.files_to_cols[en_passant[0]])
+        self.halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+        self.fullmove_number = int(fields[5]) if len(fields) > 5 else 1
 
+        self.piece_squares = self._collect_piece_squares()
+        self.move_log = []
+        self.undo_stack = []
+        self.in_check = False
+        self.pins = []
+        self.checks = []
+        self.checkmate = False
+        self.stalemate = False
+        self.valid_moves_cache = None
+        self.zobrist_key = self._compute_zobrist_key()
         self.position_history = {}
         self._update_position_history()
 
+    def to_fen(self):
+        ranks = []
+        for row in self.board:
+            rank = ''
+            empty = 0
+            for piece in row:
+                if piece == '--':
+                    empty += 1
+                    continue
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                rank += piece[1].upper() if piece[0] == 'w' else piece[1]
+            if empty:
+                rank += str(empty)
+            ranks.append(rank)
+
+        castling = ''.join(char for char, right in (('K', CASTLE_WKS), ('Q', CASTLE_WQS),
+                                                    ('k', CASTLE_BKS), ('q', CASTLE_BQS))
+                           if self.castle_rights & right) or '-'
+        if self.en_passant_possible:
+            ep_row, ep_col = self.en_passant_possible
+            en_passant = Move.cols_to_files[ep_col] + Move.rows_to_ranks[ep_row]
+        else:
+            en_passant = '-'
+        return f"{'/'.join(ranks)} {'w' if self.white_to_move else 'b'} {castling} {en_passant} " \
+               f"{self.halfmove_clock} {self.fullmove_number}"
+
     def make_move(self, move):
         if self.board[move.start_row][move.start_col] == '--':
             print(f"ERROR: Attempting to move from empty square: {move.get_notation()}")
             return
 
+        self.valid_moves_cache = None
+        captured = move.piece_captured if move.is_en_passant else self.board[move.end_row][move.end_col]
+        self.undo_stack.append((self.castle_rights, self.en_passant_possible, captured, self.zobrist_key,
+                                self.halfmove_clock))
+        if move.piece_moved[1] == 'p' or captured != '--':
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        if not self.white_to_move:
+            self.fullmove_number += 1
+
+        key = self.zobrist_key
+        key ^= ZOBRIST_PIECES[move.piece_moved][move.start_row][move.start_col]
+        if move.is_en_passant:
+            key ^= ZOBRIST_PIECES[captured][move.start_row][move.end_col]
+        elif captured != '--':
+            key ^= ZOBRIST_PIECES[captured][move.end_row][move.end_col]
+        if self.en_passant_possible:
+            key ^= ZOBRIST_EN_PASSANT[self.en_passant_possible[1]]
+        key ^= ZOBRIST_CASTLING[self.castle_rights]
+
+        piece_squares = self.piece_squares
+        bitboard_position = self.bitboard_position
+        piece_squares[move.piece_moved].remove((move.start_row, move.start_col))
+        if captured != '--':
+            piece_squares[captured].remove((move.start_row if move.is_en_passant else move.end_row, move.end_col))
+        if bitboard_position is not None:
+            bitboard_position.toggle(move.piece_moved, move.start_row, move.start_col)
+            if captured != '--':
+                bitboard_position.toggle(captured, move.start_row if move.is_en_passant else move.end_row, move.end_col)
+
         self.board[move.start_row][move.start_col] = "--"
         self.board[move.end_row][move.end_col] = move.piece_moved
 
@@ -49,32 +256,45 @@ class GameState:
             self.black_king_location = (move.end_row, move.end_col)
 
         if move.is_pawn_promotion:
-            promote_to = move.promotion_choice if move.promotion_choice in ['q', 'r', 'b', 'n'] else 'q'
+            promote_to = move.promotion_choice if move.promotion_choice in PROMOTION_PIECES else 'q'
             self.board[move.end_row][move.end_col] = move.piece_moved[0] + promote_to
+        placed = self.board[move.end_row][move.end_col]
+        piece_squares[placed].add((move.end_row, move.end_col))
+        if bitboard_position is not None:
+            bitboard_position.toggle(placed, move.end_row, move.end_col)
+        key ^= ZOBRIST_PIECES[placed][move.end_row][move.end_col]
 
         if move.is_en_passant:
             self.board[move.start_row][move.end_col] = '--'
 
         if move.piece_moved[1] == 'p' and abs(move.start_row - move.end_row) == 2:
             self.en_passant_possible = ((move.start_row + move.end_row) // 2, move.start_col)
+            key ^= ZOBRIST_EN_PASSANT[move.start_col]
         else:
             self.en_passant_possible = ()
 
         if move.is_castle:
             if move.end_col - move.start_col == 2:
-                self.board[move.end_row][move.end_col - 1] = self.board[move.end_row][move.end_col + 1]
-                self.board[move.end_row][move.end_col + 1] = "--"
+                rook_from, rook_to = move.end_col + 1, move.end_col - 1
             else:
-                self.board[move.end_row][move.end_col + 1] = self.board[move.end_row][move.end_col - 2]
-                self.board[move.end_row][move.end_col - 2] = "--"
+                rook_from, rook_to = move.end_col - 2, move.end_col + 1
+            rook = self.board[move.end_row][rook_from]
+            self.board[move.end_row][rook_to] = rook
+            self.board[move.end_row][rook_from] = "--"
+            piece_squares[rook].remove((move.end_row, rook_from))
+            piece_squares[rook].add((move.end_row, rook_to))
+            if bitboard_position is not None:
+                bitboard_position.toggle(rook, move.end_row, rook_from)
+                bitboard_position.toggle(rook, move.end_row, rook_to)
+            key ^= ZOBRIST_PIECES[rook][move.end_row][rook_from] ^ ZOBRIST_PIECES[rook][move.end_row][rook_to]
 
 
         self.update_castle_rights(move)
-        self.castle_rights_log.append(deepcopy(self.castle_rights))
-        self.en_passant_log.append(self.en_passant_possible)
+        key ^= ZOBRIST_CASTLING[self.castle_rights]
 
         self.move_log.append(move)
         self.white_to_move = not self.white_to_move
+        self.zobrist_key = key ^ ZOBRIST_BLACK_TO_MOVE
 
         self._update_position_history()
         self.checkmate = False
@@ -86,13 +306,31 @@ class GameState:
             return
 
         move = self.move_log.pop()
+        self.valid_moves_cache = None
 
         key_to_decrement = self._get_position_key()
 
         self.white_to_move = not self.white_to_move
+        self.castle_rights, self.en_passant_possible, captured, self.zobrist_key, self.halfmove_clock = \
+            self.undo_stack.pop()
+        if not self.white_to_move:
+            self.fullmove_number -= 1
+
+        piece_squares = self.piece_squares
+        bitboard_position = self.bitboard_position
+        placed = self.board[move.end_row][move.end_col]
+        piece_squares[placed].remove((move.end_row, move.end_col))
+        piece_squares[move.piece_moved].add((move.start_row, move.start_col))
+        if captured != '--':
+            piece_squares[captured].add((move.start_row if move.is_en_passant else move.end_row, move.end_col))
+        if bitboard_position is not None:
+            bitboard_position.toggle(placed, move.end_row, move.end_col)
+            bitboard_position.toggle(move.piece_moved, move.start_row, move.start_col)
+            if captured != '--':
+                bitboard_position.toggle(captured, move.start_row if move.is_en_passant else move.end_row, move.end_col)
 
         self.board[move.start_row][move.start_col] = move.piece_moved
-        self.board[move.end_row][move.end_col] = move.piece_captured
+        self.board[move.end_row][move.end_col] = captured
 
         if move.piece_moved == 'wk':
             self.white_king_location = (move.start_row, move.start_col)
@@ -101,20 +339,21 @@ class GameState:
 
         if move.is_en_passant:
             self.board[move.end_row][move.end_col] = "--"
-            captured_pawn_color = 'b' if self.white_to_move else 'w'
-            self.board[move.start_row][move.end_col] = captured_pawn_color + 'p'
+            self.board[move.start_row][move.end_col] = captured
 
-        self.en_passant_log.pop()
-        self.en_passant_possible = self.en_passant_log[-1]
-        self.castle_rights_log.pop()
-        self.castle_rights = deepcopy(self.castle_rights_log[-1])
         if move.is_castle:
             if move.end_col - move.start_col == 2:
-                self.board[move.end_row][move.end_col + 1] = self.board[move.end_row][move.end_col - 1]
-                self.board[move.end_row][move.end_col - 1] = "--"
+                rook_from, rook_to = move.end_col + 1, move.end_col - 1
             else:
-                self.board[move.end_row][move.end_col - 2] = self.board[move.end_row][move.end_col + 1]
-                self.board[move.end_row][move.end_col + 1] = "--"
+                rook_from, rook_to = move.end_col - 2, move.end_col + 1
+            rook = self.board[move.end_row][rook_to]
+            self.board[move.end_row][rook_from] = rook
+            self.board[move.end_row][rook_to] = "--"
+            piece_squares[rook].remove((move.end_row, rook_to))
+            piece_squares[rook].add((move.end_row, rook_from))
+            if bitboard_position is not None:
+                bitboard_position.toggle(rook, move.end_row, rook_to)
+                bitboard_position.toggle(rook, move.end_row, rook_from)
 
         self.checkmate = False
         self.stalemate = False
@@ -131,33 +370,49 @@ class GameState:
 
 
 
-    def get_valid_moves(self):
-        if self.is_threefold_repetition():
-            self.stalemate = True
-            return []
-
-        temp_en_passant = self.en_passant_possible
-        temp_castle_rights = deepcopy(self.castle_rights)
+    def make_null_move(self):
+        # Passes the turn for null-move pruning. Not a real move, so move_log,
+        # position_history and the move counters are left alone.
+        self.valid_moves_cache = None
+        self.undo_stack.append((self.castle_rights, self.en_passant_possible, '--', self.zobrist_key,
+                                self.halfmove_clock))
+        key = self.zobrist_key ^ ZOBRIST_BLACK_TO_MOVE
+        if self.en_passant_possible:
+            key ^= ZOBRIST_EN_PASSANT[self.en_passant_possible[1]]
+            self.en_passant_possible = ()
+        self.zobrist_key = key
+        self.white_to_move = not self.white_to_move
+        self.checkmate = False
+        self.stalemate = False
 
-        moves = self.get_all_possible_moves()
+    def undo_null_move(self):
+        self.valid_moves_cache = None
+        self.castle_rights, self.en_passant_possible, _, self.zobrist_key, self.halfmove_clock = \
+            self.undo_stack.pop()
+        self.white_to_move = not self.white_to_move
+        self.checkmate = False
+        self.stalemate = False
+        self.in_check = False
 
-        self.get_castle_moves(self.white_king_location[0], self.white_king_location[1], moves) if self.white_to_move else \
-        self.get_castle_moves(self.black_king_location[0], self.black_king_location[1], moves)
+    def get_valid_moves(self):
+        cache = self.valid_moves_cache
+        if cache is not None and cache[0] == self.zobrist_key:
+            _, moves, self.in_check, self.checkmate, self.stalemate = cache
+            return list(moves)
 
-        self.castle_rights = temp_castle_rights
+        moves = self._get_valid_moves()
+        self.valid_moves_cache = (self.zobrist_key, moves, self.in_check, self.checkmate, self.stalemate)
+        return list(moves)
 
-        for i in range(len(moves) - 1, -1, -1):
-            move = moves[i]
-            self.make_move(move)
-            self.white_to_move = not self.white_to_move
-            if self.is_in_check():
-                moves.pop(i)
+    def _get_valid_moves(self):
+        if self.is_threefold_repetition():
+            self.stalemate = True
+            return []
 
-            self.white_to_move = not self.white_to_move
-            self.undo_move()
+        moves = self.generate_legal_moves()
 
         if len(moves) == 0:
-            if self.is_in_check():
+            if self.in_check:
                 self.checkmate = True
             else:
                 self.stalemate = True
@@ -165,39 +420,394 @@ class GameState:
             self.checkmate = False
             self.stalemate = False
 
-        self.en_passant_possible = temp_en_passant
-
         if not self.checkmate and not self.stalemate and self.is_insufficient_material():
             self.stalemate = True
             return []
         return moves
 
+    def get_capture_moves(self):
+        # Legal captures and promotions only, most valuable victim / least valuable attacker first.
+        moves = self.generate_legal_moves(quiets=False)
+        moves.sort(key=mvv_lva_score, reverse=True)
+        return moves
+
+    def move_from_id(self, move_id):
+        # Rebuilds a packed Move.move_id against the current board; None if it cannot apply here.
+        start_row, start_col = divmod(move_id & 63, 8)
+        end_row, end_col = divmod((move_id >> 6) & 63, 8)
+        piece = self.board[start_row][start_col]
+        if piece == '--' or (piece[0] == 'w') != self.white_to_move or self.board[end_row][end_col][0] == piece[0]:
+            return None
+        promotion = move_id >> 12
+        is_castle = piece[1] == 'k' and abs(end_col - start_col) == 2
+        is_en_passant = piece[1] == 'p' and start_col != end_col and (end_row, end_col) == self.en_passant_possible
+        return Move((start_row, start_col), (end_row, end_col), self.board, is_en_passant=is_en_passant,
+                    is_castle=is_castle, is_pawn_promotion=promotion > 0,
+                    promotion_choice=PROMOTION_PIECES[promotion - 1] if promotion else 'q')
+
+    def generate_legal_moves(self, captures=True, quiets=True):
+        # captures covers every capture and promotion, quiets everything else (castling included).
+        if self.bitboard_position is not None:
+            return self._generate_bitboard_moves(captures, quiets)
+        self.in_check, self.pins, self.checks = self.check_for_pins_and_checks()
+        king_row, king_col = self.white_king_location if self.white_to_move else self.black_king_location
+
+        if self.in_check and len(self.checks) > 1:
+            moves = []
+            self.get_king_moves(king_row, king_col, moves, captures, quiets)
+        else:
+            moves = self.get_all_possible_moves(captures, quiets)
+            if self.in_check:
+                check_row, check_col, check_dr, check_dc = self.checks[0]
+                if self.board[check_row][check_col][1] == 'n':
+                    valid_squares = {(check_row, check_col)}
+                else:
+                    valid_squares = set()
+                    for i in range(1, 8):
+                        square = (king_row + check_dr * i, king_col + check_dc * i)
+                        valid_squares.add(square)
+                        if square == (check_row, check_col):
+                            break
+                moves = [m for m in moves
+                         if m.piece_moved[1] == 'k' or (m.end_row, m.end_col) in valid_squares or
+                         (m.is_en_passant and (m.start_row, m.end_col) == (check_row, check_col))]
+            elif quiets:
+                self.get_castle_moves(king_row, king_col, moves)
+
+        return [m for m in moves if m.piece_moved[1] != 'k' or m.is_castle or
+                self._king_move_is_safe(m.start_row, m.start_col, m.end_row, m.end_col)]
+
+    def _generate_bitboard_moves(self, captures, quiets):
+        """Legal moves of the bitboard backend.
+
+        Target squares come straight from the attack tables, masked by occupancy, by the
+        check evasion squares and by the line of a pinned piece, so nothing is generated
+        only to be filtered out again, apart from king steps onto attacked squares.
+        """
+        position = self.bitboard_position
+        bitboards = position.bitboards
+        board = self.board
+        ally_color, enemy_color = ('w', 'b') if self.white_to_move else ('b', 'w')
+        allies = position.occupancy[ally_color]
+        enemies = position.occupancy[enemy_color]
+        occupied = allies | enemies
+        empty = ALL_SQUARES ^ occupied
+        king_row, king_col = self.white_king_location if self.white_to_move else self.black_king_location
+        king_sq = king_row * 8 + king_col
+
+        checkers = position.attackers(king_sq, enemy_color, occupied)
+        self.in_check = checkers != 0
+        self.pins = []
+        self.checks = []
+        moves = []
+
+        king_targets = KING_ATTACKS[king_sq] & ((enemies if captures else 0) | (empty if quiets else 0))
+        without_king = occupied ^ (1 << king_sq)
+        for target in iter_squares(king_targets):
+            if not position.is_attacked(target, enemy_color, without_king):
+                moves.append(Move(SQUARES[king_sq], SQUARES[target], board))
+        if checkers & (checkers - 1):
+            return moves
+
+        # Squares a non-king move has to land on: anywhere, or onto the checker or between it and the king.
+        evasions = ALL_SQUARES
+        if checkers:
+            checker_sq = checkers.bit_length() - 1
+            evasions = BETWEEN[king_sq][checker_sq] | checkers
+        pin_lines = position.pins(king_sq, ally_color, enemy_color, occupied)
+        targets = ((enemies if captures else 0) | (empty if quiets else 0)) & evasions
+
+        for piece_type, attacks in (('n', None), ('b', bishop_attacks), ('r', rook_attacks), ('q', queen_attacks)):
+            for sq in iter_squares(bitboards[ally_color + piece_type]):
+                if attacks is None:
+                    # A pinned knight can never stay on the pin line.
+                    if sq in pin_lines:
+                        continue
+                    piece_targets = KNIGHT_ATTACKS[sq] & targets
+                else:
+                    piece_targets = attacks(sq, occupied) & targets
+                    if sq in pin_lines:
+                        piece_targets &= pin_lines[sq]
+                start = SQUARES[sq]
+                # iter_squares inlined: this loop builds most of the moves.
+                while piece_targets:
+                    low_bit = piece_targets & -piece_targets
+                    moves.append(Move(start, SQUARES[low_bit.bit_length() - 1], board))
+                    piece_targets ^= low_bit
+
+        self._add_bitboard_pawn_moves(moves, captures, quiets, ally_color, enemies, empty, evasions, pin_lines,
+                                      king_sq, occupied, checkers)
+
+        if quiets and not checkers:
+            self._add_bitboard_castle_moves(moves, king_row, king_col, occupied, enemy_color)
+        return moves
+
+    def _add_bitboard_pawn_moves(self, moves, captures, quiets, ally_color, enemies, empty, evasions, pin_lines,
+                                 king_sq, occupied, checkers):
+        # Pushes and captures are shifted for all pawns at once; step is the square offset of a single push.
+        board = self.board
+        pawns = self.bitboard_position.bitboards[ally_color + 'p']
+        if ally_color == 'w':
+            step = -8
+            single = (pawns >> 8) & empty
+            double = ((single & ROWS[5]) >> 8) & empty
+            west_captures = ((pawns & ~FILE_A) >> 9) & enemies
+            east_captures = ((pawns & ~FILE_H) >> 7) & enemies
+            promotion_row = ROWS[0]
+        else:
+            step = 8
+            single = (pawns << 8) & empty
+            double = ((single & ROWS[2]) << 8) & empty
+            west_captures = ((pawns & ~FILE_A) << 7) & enemies
+            east_captures = ((pawns & ~FILE_H) << 9) & enemies
+            promotion_row = ROWS[7]
+
+        # Promotions count as captures even when they are pushes.
+        push_targets = (promotion_row if captures else 0) | ((ALL_SQUARES ^ promotion_row) if quiets else 0)
+        if not captures:
+            west_captures = east_captures = 0
+        for targets, offset in ((single & push_targets, step), (double & push_targets, 2 * step),
+                                (west_captures, step - 1), (east_captures, step + 1)):
+            for target in iter_squares(targets & evasions):
+                sq = target - offset
+                if sq in pin_lines and not (pin_lines[sq] >> target) & 1:
+                    continue
+                if (promotion_row >> target) & 1:
+                    for piece in PROMOTION_PIECES:
+                        moves.append(Move(SQUARES[sq], SQUARES[target], board, is_pawn_promotion=True,
+                                          promotion_choice=piece))
+                else:
+                    moves.append(Move(SQUARES[sq], SQUARES[target], board))
+
+        if not captures or not self.en_passant_possible:
+            return
+        ep_row, ep_col = self.en_passant_possible
+        ep_sq = ep_row * 8 + ep_col
+        captured_sq = ep_sq - step
+        if not ((evasions >> ep_sq) & 1 or (checkers >> captured_sq) & 1):
+            return
+        enemy_color = 'b' if ally_color == 'w' else 'w'
+        bitboards = self.bitboard_position.bitboards
+        enemy_queens = bitboards[enemy_color + 'q']
+        # The one square whose moves take two pieces off a line: check the king against the sliders directly.
+        for sq in iter_squares(PAWN_ATTACKS[enemy_color][ep_sq] & pawns):
+            after = occupied ^ (1 << sq) ^ (1 << captured_sq) | (1 << ep_sq)
+            if rook_attacks(king_sq, after) & (bitboards[enemy_color + 'r'] | enemy_queens) or \
+               bishop_attacks(king_sq, after) & (bitboards[enemy_color + 'b'] | enemy_queens):
+                continue
+            moves.append(Move(SQUARES[sq], SQUARES[ep_sq], board, is_en_passant=True))
+
+    def _add_bitboard_castle_moves(self, moves, r, c, occupied, enemy_color):
+        position = self.bitboard_position
+        king_sq = r * 8 + c
+        if self.castle_rights & (CASTLE_WKS if self.white_to_move else CASTLE_BKS):
+            if not (occupied >> (king_sq + 1)) & 3 and \
+               not position.is_attacked(king_sq + 1, enemy_color, occupied) and \
+               not position.is_attacked(king_sq + 2, enemy_color, occupied):
+                moves.append(Move((r, c), (r, c + 2), self.board, is_castle=True))
+        if self.castle_rights & (CASTLE_WQS if self.white_to_move else CASTLE_BQS):
+            if not (occupied >> (king_sq - 3)) & 7 and \
+               not position.is_attacked(king_sq - 1, enemy_color, occupied) and \
+               not position.is_attacked(king_sq - 2, enemy_color, occupied):
+                moves.append(Move((r, c), (r, c - 2), self.board, is_castle=True))
+
+    def check_for_pins_and_checks(self):
+        pins = []
+        checks = []
+        in_check = False
+        if self.white_to_move:
+            enemy_color, ally_color = 'b', 'w'
+            start_row, start_col = self.white_king_location
+        else:
+            enemy_color, ally_color = 'w', 'b'
+            start_row, start_col = self.black_king_location
+
+        directions = ((-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1))
+        for j, (dr, dc) in enumerate(directions):
+            possible_pin = ()
+            for i in range(1, 8):
+                end_row, end_col = start_row + dr * i, start_col + dc * i
+                if not (0 <= end_row < 8 and 0 <= end_col < 8):
+                    break
+                end_piece = self.board[end_row][end_col]
+                if end_piece[0] == ally_color:
+                    if possible_pin == ():
+                        possible_pin = (end_row, end_col, dr, dc)
+                    else:
+                        break
+                elif end_piece[0] == enemy_color:
+                    piece_type = end_piece[1]
+                    # Pawns only attack the king from the two diagonals facing it.
+                    if (j <= 3 and piece_type == 'r') or (j >= 4 and piece_type == 'b') or piece_type == 'q' or \
+                       (i == 1 and piece_type == 'k') or \
+                       (i == 1 and piece_type == 'p' and ((enemy_color == 'w' and j >= 6) or (enemy_color == 'b' and 4 <= j <= 5))):
+                        if possible_pin == ():
+                            in_check = True
+                            checks.append((end_row, end_col, dr, dc))
+                        else:
+                            pins.append(possible_pin)
+                    break
+
+        knight_moves = ((-2, -1), (-2, 1), (-1, -2), (-1, 2),
+                        (1, -2), (1, 2), (2, -1), (2, 1))
+        for dr, dc in knight_moves:
+            end_row, end_col = start_row + dr, start_col + dc
+            if 0 <= end_row < 8 and 0 <= end_col < 8 and self.board[end_row][end_col] == enemy_color + 'n':
+                in_check = True
+                checks.append((end_row, end_col, dr, dc))
+        return in_check, pins, checks
+
+    def _get_pin_direction(self, r, c):
+        for pin in self.pins:
+            if pin[0] == r and pin[1] == c:
+                return pin[2], pin[3]
+        return None
+
+    def _king_move_is_safe(self, r, c, end_row, end_col):
+        king = self.board[r][c]
+        captured = self.board[end_row][end_col]
+        self.board[r][c] = '--'
+        self.board[end_row][end_col] = king
+        in_check = self.square_attacked_by(end_row, end_col, 'b' if king[0] == 'w' else 'w')
+        self.board[end_row][end_col] = captured
+        self.board[r][c] = king
+        return not in_check
+
+    def _en_passant_is_safe(self, r, c, end_row, end_col):
+        # Removing both pawns from the rank can expose the king to a rook or queen.
+        pawn = self.board[r][c]
+        captured = self.board[r][end_col]
+        self.board[r][c] = '--'
+        self.board[r][end_col] = '--'
+        self.board[end_row][end_col] = pawn
+        in_check = self.is_in_check()
+        self.board[end_row][end_col] = '--'
+        self.board[r][end_col] = captured
+        self.board[r][c] = pawn
+        return not in_check
+
     def is_in_check(self):
         king_pos = self.white_king_location if self.white_to_move else self.black_king_location
         return self.square_under_attack(king_pos[0], king_pos[1])
 
     def square_under_attack(self, r, c):
-        self.white_to_move = not self.white_to_move
-        opponent_moves = self.get_all_possible_moves()
-        self.white_to_move = not self.white_to_move
+        return self.square_attacked_by(r, c, 'b' if self.white_to_move else 'w')
+
+    def square_attacked_by(self, r, c, attacker_color):
+        if self.bitboard_position is not None:
+            return self.bitboard_position.is_attacked(square_index(r, c), attacker_color)
 
-        for move in opponent_moves:
-            if move.end_row == r and move.end_col == c:
+        board = self.board
+        knight = attacker_color + 'n'
+        for end_row, end_col in KNIGHT_TARGETS[r][c]:
+            if board[end_row][end_col] == knight:
                 return True
+
+        king = attacker_color + 'k'
+        for end_row, end_col in KING_TARGETS[r][c]:
+            if board[end_row][end_col] == king:
+                return True
+
+        pawn_row = r + 1 if attacker_color == 'w' else r - 1
+        if 0 <= pawn_row < 8:
+            pawn = attacker_color + 'p'
+            if (c > 0 and board[pawn_row][c - 1] == pawn) or (c < 7 and board[pawn_row][c + 1] == pawn):
+                return True
+
+        rook, queen, bishop = attacker_color + 'r', attacker_color + 'q', attacker_color + 'b'
+        for ray in ORTHOGONAL_RAYS[r][c]:
+            for end_row, end_col in ray:
+                piece = board[end_row][end_col]
+                if piece != '--':
+                    if piece == rook or piece == queen:
+                        return True
+                    break
+        for ray in DIAGONAL_RAYS[r][c]:
+            for end_row, end_col in ray:
+                piece = board[end_row][end_col]
+                if piece != '--':
+                    if piece == bishop or piece == queen:
+                        return True
+                    break
         return False
 
-    def get_all_possible_moves(self):
+    def static_exchange_evaluation(self, move):
+        """Material the side making the move nets once every recapture on the target
+        square is played out, cheapest attacker first and either side free to stop.
+
+        Pins are ignored, so the result is an estimate for ordering and pruning.
+        """
+        r, c = move.end_row, move.end_col
+        removed = {(move.start_row, move.start_col)}
+        gains = [SEE_VALUES[move.piece_captured[1]] if move.piece_captured != '--' else 0]
+        on_square = move.piece_moved[1]
+        if move.is_en_passant:
+            removed.add((move.start_row, move.end_col))
+        if move.is_pawn_promotion:
+            on_square = move.promotion_choice
+            gains[0] += SEE_VALUES[on_square] - SEE_VALUES['p']
+        color = 'b' if move.piece_moved[0] == 'w' else 'w'
+
+        while True:
+            attacker = self._least_valuable_attacker(r, c, color, removed)
+            if attacker is None:
+                break
+            square, piece_type = attacker
+            other_color = 'b' if color == 'w' else 'w'
+            if piece_type == 'k' and self._least_valuable_attacker(r, c, other_color, removed | {square}):
+                break
+            gains.append(SEE_VALUES[on_square] - gains[-1])
+            removed.add(square)
+            on_square = piece_type
+            color = other_color
+
+        while len(gains) > 1:
+            last_gain = gains.pop()
+            gains[-1] = -max(-gains[-1], last_gain)
+        return gains[0]
+
+    def _least_valuable_attacker(self, r, c, color, removed):
+        # Squares in removed count as empty, so x-ray attackers behind them show up.
+        board = self.board
+        pawn_row = r + 1 if color == 'w' else r - 1
+        if 0 <= pawn_row < 8:
+            for pawn_col in (c - 1, c + 1):
+                if 0 <= pawn_col < 8 and board[pawn_row][pawn_col] == color + 'p' and \
+                   (pawn_row, pawn_col) not in removed:
+                    return (pawn_row, pawn_col), 'p'
+        for square in KNIGHT_TARGETS[r][c]:
+            if board[square[0]][square[1]] == color + 'n' and square not in removed:
+                return square, 'n'
+
+        sliders = []
+        for rays, piece_types in ((DIAGONAL_RAYS, 'bq'), (ORTHOGONAL_RAYS, 'rq')):
+            for ray in rays[r][c]:
+                for square in ray:
+                    piece = board[square[0]][square[1]]
+                    if piece == '--' or square in removed:
+                        continue
+                    if piece[0] == color and piece[1] in piece_types:
+                        sliders.append((SEE_VALUES[piece[1]], square, piece[1]))
+                    break
+        if sliders:
+            _, square, piece_type = min(sliders)
+            return square, piece_type
+
+        for square in KING_TARGETS[r][c]:
+            if board[square[0]][square[1]] == color + 'k' and square not in removed:
+                return square, 'k'
+        return None
+
+    def get_all_possible_moves(self, captures=True, quiets=True):
         moves = []
-        for r in range(8):
-            for c in range(8):
-                turn = self.board[r][c][0]
-                if (turn == 'w' and self.white_to_move) or \
-                   (turn == 'b' and not self.white_to_move):
-                    piece = self.board[r][c][1]
-                    self.move_functions[piece](r, c, moves)
+        for piece in (WHITE_PIECE_CODES if self.white_to_move else BLACK_PIECE_CODES):
+            move_function = self.move_functions[piece[1]]
+            for r, c in self.piece_squares[piece]:
+                move_function(r, c, moves, captures, quiets)
         return moves
 
-    def get_pawn_moves(self, r, c, moves):
+    def get_pawn_moves(self, r, c, moves, captures=True, quiets=True):
+        pin_direction = self._get_pin_direction(r, c)
         piece_color = self.board[r][c][0]
         direction = -1 if piece_color == 'w' else 1
         enemy_color = 'b' if piece_color == 'w' else 'w'
@@ -205,101 +815,100 @@ class GameState:
         promotion_row = 0 if piece_color == 'w' else 7
 
         if 0 <= r + direction < 8 and self.board[r + direction][c] == "--":
-            if r + direction == promotion_row:
-                 moves.append(Move((r, c), (r + direction, c), self.board, is_pawn_promotion=True))
-            else:
-                 moves.append(Move((r, c), (r + direction, c), self.board))
-            if r == start_row and self.board[r + 2 * direction][c] == "--":
-                moves.append(Move((r, c), (r + 2 * direction, c), self.board))
-
+            if pin_direction is None or pin_direction in ((direction, 0), (-direction, 0)):
+                if r + direction == promotion_row:
+                    if captures:
+                        for piece in PROMOTION_PIECES:
+                            moves.append(Move((r, c), (r + direction, c), self.board, is_pawn_promotion=True, promotion_choice=piece))
+                elif quiets:
+                    moves.append(Move((r, c), (r + direction, c), self.board))
+                    if r == start_row and self.board[r + 2 * direction][c] == "--":
+                        moves.append(Move((r, c), (r + 2 * direction, c), self.board))
+
+        if not captures:
+            return
         for dc in [-1, 1]:
             if 0 <= c + dc < 8 and 0 <= r + direction < 8:
                 target_square = self.board[r + direction][c + dc]
                 if target_square[0] == enemy_color:
+                    if pin_direction is not None and pin_direction not in ((direction, dc), (-direction, -dc)):
+                        continue
                     if r + direction == promotion_row:
-                        moves.append(Move((r, c), (r + direction, c + dc), self.board, is_pawn_promotion=True))
+                        for piece in PROMOTION_PIECES:
+                            moves.append(Move((r, c), (r + direction, c + dc), self.board, is_pawn_promotion=True, promotion_choice=piece))
                     else:
                         moves.append(Move((r, c), (r + direction, c + dc), self.board))
                 elif (r + direction, c + dc) == self.en_passant_possible:
-                    moves.append(Move((r, c), (r + direction, c + dc), self.board, is_en_passant=True))
+                    if self._en_passant_is_safe(r, c, r + direction, c + dc):
+                        moves.append(Move((r, c), (r + direction, c + dc), self.board, is_en_passant=True))
 
-    def get_rook_moves(self, r, c, moves):
-        ally_color = self.board[r][c][0]
-        directions = ((1, 0), (-1, 0), (0, 1), (0, -1))
-        for dr, dc in directions:
-            for i in range(1, 8):
-                end_row, end_col = r + dr * i, c + dc * i
-                if 0 <= end_row < 8 and 0 <= end_col < 8:
-                    end_piece = self.board[end_row][end_col]
-                    if end_piece == "--":
-                        moves.append(Move((r, c), (end_row, end_col), self.board))
-                    elif end_piece[0] != ally_color:
-                        moves.append(Move((r, c), (end_row, end_col), self.board))
-                        break
-                    else:
-                        break
-                else:
-                    break
+    def get_rook_moves(self, r, c, moves, captures=True, quiets=True):
+        self._get_slider_moves(r, c, ((1, 0), (-1, 0), (0, 1), (0, -1)), moves, captures, quiets)
 
-    def get_knight_moves(self, r, c, moves):
-        ally_color = self.board[r][c][0]
-        knight_moves = ((-2, -1), (-2, 1), (-1, -2), (-1, 2),
-                        (1, -2), (1, 2), (2, -1), (2, 1))
-        for dr, dc in knight_moves:
-            end_row, end_col = r + dr, c + dc
-            if 0 <= end_row < 8 and 0 <= end_col < 8:
-                end_piece = self.board[end_row][end_col]
-                if end_piece[0] != ally_color:
-                    moves.append(Move((r, c), (end_row, end_col), self.board))
+    def get_knight_moves(self, r, c, moves, captures=True, quiets=True):
+        if self._get_pin_direction(r, c) is not None:
+            return
+        self._get_step_moves(r, c, ((-2, -1), (-2, 1), (-1, -2), (-1, 2),
+                                    (1, -2), (1, 2), (2, -1), (2, 1)), moves, captures, quiets)
 
-    def get_bishop_moves(self, r, c, moves):
+    def get_bishop_moves(self, r, c, moves, captures=True, quiets=True):
+        self._get_slider_moves(r, c, ((1, 1), (1, -1), (-1, 1), (-1, -1)), moves, captures, quiets)
+
+    def _get_slider_moves(self, r, c, directions, moves, captures, quiets):
+        pin_direction = self._get_pin_direction(r, c)
         ally_color = self.board[r][c][0]
-        directions = ((1, 1), (1, -1), (-1, 1), (-1, -1))
         for dr, dc in directions:
+            if pin_direction is not None and pin_direction != (dr, dc) and pin_direction != (-dr, -dc):
+                continue
             for i in range(1, 8):
                 end_row, end_col = r + dr * i, c + dc * i
                 if 0 <= end_row < 8 and 0 <= end_col < 8:
                     end_piece = self.board[end_row][end_col]
                     if end_piece == "--":
-                        moves.append(Move((r, c), (end_row, end_col), self.board))
+                        if quiets:
+                            moves.append(Move((r, c), (end_row, end_col), self.board))
                     elif end_piece[0] != ally_color:
-                        moves.append(Move((r, c), (end_row, end_col), self.board))
+                        if captures:
+                            moves.append(Move((r, c), (end_row, end_col), self.board))
                         break
                     else:
                         break
                 else:
                     break
 
-    def get_queen_moves(self, r, c, moves):
-        self.get_rook_moves(r, c, moves)
-        self.get_bishop_moves(r, c, moves)
-
-    def get_king_moves(self, r, c, moves):
+    def _get_step_moves(self, r, c, offsets, moves, captures, quiets):
         ally_color = self.board[r][c][0]
-        king_moves = ((1, 0), (-1, 0), (0, 1), (0, -1),
-                      (1, 1), (1, -1), (-1, 1), (-1, -1))
-        for dr, dc in king_moves:
+        for dr, dc in offsets:
             end_row, end_col = r + dr, c + dc
             if 0 <= end_row < 8 and 0 <= end_col < 8:
                 end_piece = self.board[end_row][end_col]
-                if end_piece[0] != ally_color:
+                if end_piece == "--":
+                    if quiets:
+                        moves.append(Move((r, c), (end_row, end_col), self.board))
+                elif end_piece[0] != ally_color and captures:
                     moves.append(Move((r, c), (end_row, end_col), self.board))
 
+    def get_queen_moves(self, r, c, moves, captures=True, quiets=True):
+        self.get_rook_moves(r, c, moves, captures, quiets)
+        self.get_bishop_moves(r, c, moves, captures, quiets)
+
+    def get_king_moves(self, r, c, moves, captures=True, quiets=True):
+        self._get_step_moves(r, c, ((1, 0), (-1, 0), (0, 1), (0, -1),
+                                    (1, 1), (1, -1), (-1, 1), (-1, -1)), moves, captures, quiets)
+
     def get_castle_moves(self, r, c, moves):
          if self.square_under_attack(r, c):
              return
 
          ally_color = 'w' if self.white_to_move else 'b'
 
-         if (self.white_to_move and self.castle_rights.wks) or \
-            (not self.white_to_move and self.castle_rights.bks):
+         if self.castle_rights & (CASTLE_WKS if self.white_to_move else CASTLE_BKS):
              if self.board[r][c + 1] == "--" and self.board[r][c + 2] == "--":
                  if not self.square_under_attack(r, c + 1) and \
                     not self.square_under_attack(r, c + 2):
                      moves.append(Move((r, c), (r, c + 2), self.board, is_castle=True))
 
-         if (self.white_to_move and self.castle_rights.wqs) or \
-            (not self.white_to_move and self.castle_rights.bqs):
+         if self.castle_rights & (CASTLE_WQS if self.white_to_move else CASTLE_BQS):
              if self.board[r][c - 1] == "--" and self.board[r][c - 2] == "--" and \
                 self.board[r][c - 3] == "--":
                   if not self.square_under_attack(r, c - 1) and \
@@ -308,94 +917,94 @@ class GameState:
 
 
     def update_castle_rights(self, move):
-        if move.piece_moved == 'wk':
-            self.castle_rights.wks = False
-            self.castle_rights.wqs = False
-        elif move.piece_moved == 'bk':
-            self.castle_rights.bks = False
-            self.castle_rights.bqs = False
-
-        if move.piece_moved == 'wr':
-            if move.start_row == 7:
-                if move.start_col == 0:
-                    self.castle_rights.wqs = False
-                elif move.start_col == 7:
-                    self.castle_rights.wks = False
-        elif move.piece_moved == 'br':
-             if move.start_row == 0:
-                if move.start_col == 0:
-                    self.castle_rights.bqs = False
-                elif move.start_col == 7:
-                    self.castle_rights.bks = False
-
-        if move.piece_captured == 'wr':
-            if move.end_row == 7:
-                if move.end_col == 0:
-                    self.castle_rights.wqs = False
-                elif move.end_col == 7:
-                    self.castle_rights.wks = False
-        elif move.piece_captured == 'br':
-            if move.end_row == 0:
-                if move.end_col == 0:
-                    self.castle_rights.bqs = False
-                elif move.end_col == 7:
-                    self.castle_rights.bks = False
+        self.castle_rights &= CASTLE_MASK[move.start_row][move.start_col] & CASTLE_MASK[move.end_row][move.end_col]
 
     def _update_position_history(self):
         key = self._get_position_key()
         self.position_history[key] = self.position_history.get(key, 0) + 1
 
+    def _collect_piece_squares(self):
+        piece_squares = {piece: set() for piece in PIECE_CODES}
+        for r in range(8):
+            for c in range(8):
+                if self.board[r][c] != '--':
+                    piece_squares[self.board[r][c]].add((r, c))
+        return piece_squares
+
     def _get_position_key(self):
-        return ''.join(''.join(row) for row in self.board) + \
-               ('w' if self.white_to_move else 'b') + \
-               ('K' if self.castle_rights.wks else '') + \
-               ('Q' if self.castle_rights.wqs else '') + \
-               ('k' if self.castle_rights.bks else '') + \
-               ('q' if self.castle_rights.bqs else '') + \
-               (str(self.en_passant_possible) if self.en_passant_possible else '-')
+        return self.zobrist_key
+
+    def _compute_zobrist_key(self):
+        key = 0
+        for r in range(8):
+            for c in range(8):
+                piece = self.board[r][c]
+                if piece != '--':
+                    key ^= ZOBRIST_PIECES[piece][r][c]
+        if not self.white_to_move:
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        key ^= ZOBRIST_CASTLING[self.castle_rights]
+        if self.en_passant_possible:
+            key ^= ZOBRIST_EN_PASSANT[self.en_passant_possible[1]]
+        return key
+
+    def perft(self, depth):
+        if depth <= 0:
+            return 1
+        moves = self.generate_legal_moves()
+        # Bulk counting: the last ply only needs the number of legal moves, not the moves themselves.
+        if depth == 1:
+            return len(moves)
+        nodes = 0
+        for move in moves:
+            self.make_move(move)
+            nodes += self.perft(depth - 1)
+            self.undo_move()
+        return nodes
+
+    def divide(self, depth):
+        results = []
+        for move in self.generate_legal_moves():
+            self.make_move(move)
+            results.append((move, self.perft(depth - 1)))
+            self.undo_move()
+        return results
 
     def is_threefold_repetition(self):
         key = self._get_position_key()
         return self.position_history.get(key, 0) >= 3
 
     def is_insufficient_material(self):
-        piece_counts = Counter()
-        other_pieces = 0
-        for r in range(8):
-            for c in range(8):
-                piece = self.board[r][c]
-                if piece != '--' and piece[1] != 'k':
-                    piece_counts[piece] += 1
-                    other_pieces += 1
-
-        if other_pieces == 0:
-            return True
-        if other_pieces == 1 and (piece_counts['wn'] == 1 or piece_counts['bn'] == 1):
-            return True
-        if other_pieces == 1 and (piece_counts['wb'] == 1 or piece_counts['bb'] == 1):
+        piece_squares = self.piece_squares
+        for piece in ('wp', 'wr', 'wq', 'bp', 'br', 'bq'):
+            if piece_squares[piece]:
+                return False
+        minor_pieces = {piece: len(piece_squares[piece]) for piece in ('wn', 'wb', 'bn', 'bb')}
+        other_pieces = sum(minor_pieces.values())
+
+        if other_pieces <= 1:
             return True
-        if other_pieces == 2 and piece_counts['wb'] == 1 and piece_counts['bb'] == 1:
-            wb_pos = None
-            bb_pos = None
-            for r in range(8):
-                for c in range(8):
-                    piece = self.board[r][c]
-                    if piece == 'wb': wb_pos = (r, c)
-                    if piece == 'bb': bb_pos = (r, c)
-            if wb_pos and bb_pos:
-                 if (wb_pos[0] + wb_pos[1]) % 2 == (bb_pos[0] + bb_pos[1]) % 2:
-                     return True
+        if other_pieces == 2 and minor_pieces['wb'] == 1 and minor_pieces['bb'] == 1:
+            (wb_r, wb_c), = piece_squares['wb']
+            (bb_r, bb_c), = piece_squares['bb']
+            if (wb_r + wb_c) % 2 == (bb_r + bb_c) % 2:
+                return True
 
         return False
 
-class CastleRights:
-    def __init__(self, wks, wqs, bks, bqs):
-        self.wks = wks
-        self.wqs = wqs
-        self.bks = bks
-        self.bqs = bqs
+def mvv_lva_score(move):
+    score = -MVV_LVA_VALUES[move.piece_moved[1]]
+    if move.piece_captured != '--':
+        score += 10 * MVV_LVA_VALUES[move.piece_captured[1]]
+    if move.is_pawn_promotion:
+        score += 10 * MVV_LVA_VALUES[move.promotion_choice]
+    return score
 
 class Move:
+    # Searches create and discard moves by the tens of thousands, so they carry no per-instance dict.
+    __slots__ = ('start_row', 'start_col', 'end_row', 'end_col', 'piece_moved', 'piece_captured',
+                 'is_en_passant', 'is_castle', 'is_pawn_promotion', 'promotion_choice', 'move_id')
+
     ranks_to_rows = {"1": 7, "2": 6, "3": 5, "4": 4,
                      "5": 3, "6": 2, "7": 1, "8": 0}
     rows_to_ranks = {v: k for k, v in ranks_to_rows.items()}
@@ -404,27 +1013,38 @@ class Move:
     cols_to_files = {v: k for k, v in files_to_cols.items()}
 
     def __init__(self, start_sq, end_sq, board, is_en_passant=False, is_castle=False, is_pawn_promotion=False, promotion_choice='q'):
-        self.start_row, self.start_col = start_sq
-        self.end_row, self.end_col = end_sq
-        self.piece_moved = board[self.start_row][self.start_col]
+        start_row, start_col = start_sq
+        end_row, end_col = end_sq
+        self.start_row = start_row
+        self.start_col = start_col
+        self.end_row = end_row
+        self.end_col = end_col
+        piece_moved = board[start_row][start_col]
+        self.piece_moved = piece_moved
 
         if is_en_passant:
-             captured_pawn_color = 'b' if self.piece_moved[0] == 'w' else 'w'
-             self.piece_captured = captured_pawn_color + 'p'
+             self.piece_captured = 'bp' if piece_moved[0] == 'w' else 'wp'
         elif is_castle:
             self.piece_captured = '--'
         else:
-             self.piece_captured = board[self.end_row][self.end_col]
+             self.piece_captured = board[end_row][end_col]
 
         self.is_en_passant = is_en_passant
         self.is_castle = is_castle
-        self.is_pawn_promotion = is_pawn_promotion and (self.piece_moved[1] == 'p') and (self.end_row == 0 or self.end_row == 7)
+        self.is_pawn_promotion = is_pawn_promotion and piece_moved[1] == 'p' and (end_row == 0 or end_row == 7)
         self.promotion_choice = promotion_choice if self.is_pawn_promotion else None
-        self.move_id = self.start_row * 1000 + self.start_col * 100 + self.end_row * 10 + self.end_col
+        # From-square in the low 6 bits, to-square in the next 6 (square = row * 8 + col),
+        # then 1-4 for a promotion to q, r, b or n.
+        self.move_id = (start_row << 3 | start_col) | (end_row << 3 | end_col) << 6
+        if self.is_pawn_promotion:
+            self.move_id |= (PROMOTION_PIECES.index(self.promotion_choice) + 1) << 12
 
     def __eq__(self, other):
         return isinstance(other, Move) and self.move_id == other.move_id
 
+    def __hash__(self):
+        return self.move_id
+
     def __str__(self):
         return self.get_notation()
 
@@ -437,9 +1057,28 @@ class Move:
         notation = start + end
 
         if self.is_pawn_promotion:
-            notation += 'q'
+            notation += self.promotion_choice
 
         return notation
 
     def get_rank_file(self, r, c):
-        return self.cols_to_files[c] + self.rows_to_ranks[r]
\ No newline at end of file
+        return self.cols_to_files[c] + self.rows_to_ranks[r]
+
+
+def read_epd(path, backend='list'):
+    """Yields (GameState, operations) for each position in an EPD file, one line at a time."""
+    with open(path) as epd_file:
+        for line in epd_file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split(None, 4)
+            operations = {}
+            if len(fields) > 4:
+                for operation in fields[4].split(';'):
+                    operation = operation.strip()
+                    if operation:
+                        opcode, _, operand = operation.partition(' ')
+                        operations[opcode] = operand.strip().strip('"')
+            fen = ' '.join(fields[:4] + [operations.get('hmvc', '0'), operations.get('fmvn', '1')])
+            yield GameState.from_fen(fen, backend=backend), operations
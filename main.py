@@ -8,11 +8,13 @@ from chess_visualizer import ChessVisualizer
 from minimax_ai import ChessAI 
 from game_state import GameState, Move 
 
-def ai_thread_function(ai, use_iterative_deepening, max_time_seconds, result_container):
+def ai_thread_function(ai, use_iterative_deepening, max_time_seconds, result_container, remaining_time=None,
+                       increment=0.0):
     """Run AI thinking in a separate thread"""
     try:
         move = ai.get_best_move(use_iterative_deepening=use_iterative_deepening, 
-                              max_time_seconds=max_time_seconds)
+                              max_time_seconds=max_time_seconds,
+                              remaining_time=remaining_time, increment=increment)
         result_container['move'] = move
     except Exception as e:
         result_container['error'] = str(e)
@@ -31,6 +33,15 @@ def random_move(game: GameState):
 
     return selected_move
 
+def parse_clock(text):
+    """Parses a 'seconds+increment' clock such as '300+2' into a (seconds, increment) pair."""
+    seconds, _, increment = text.partition('+')
+    seconds = float(seconds)
+    increment = float(increment) if increment else 0.0
+    if seconds <= 0 or increment < 0:
+        raise ValueError(f"Invalid clock: {text!r}")
+    return seconds, increment
+
 def print_board_simple(board):
     """Basic console print for debugging."""
     print("  a b c d e f g h")
@@ -45,10 +56,13 @@ def print_board_simple(board):
     print(" +-----------------+")
     print("  a b c d e f g h")
 
-def play_game(mode, ai_depth, visualizer, player_wants_black=False):
+def play_game(mode, ai_depth, visualizer, player_wants_black=False, ai_clock=None):
+    """ai_clock is an optional (seconds, increment) pair; without it the AI gets 10 seconds a move."""
     game = GameState(player_wants_black=player_wants_black)
     ai = None
     ai_color = None
+    ai_remaining_time = ai_clock[0] if ai_clock else None
+    ai_increment = ai_clock[1] if ai_clock else 0.0
 
     if "ai" in mode:
         ai_color = 'b' if not player_wants_black else 'w'
@@ -95,7 +109,14 @@ def play_game(mode, ai_depth, visualizer, player_wants_black=False):
                     print(f"Promoting to: {chosen_piece.upper()}")
 
                     if promotion_move_pending and isinstance(promotion_move_pending, Move):
-                        promotion_move_pending.promotion_choice = chosen_piece # Set the choice
+                        # Each promotion piece is its own generated move; pick the one that was chosen.
+                        for m in game.get_valid_moves():
+                            if m.is_pawn_promotion and m.promotion_choice == chosen_piece and \
+                               (m.start_row, m.start_col, m.end_row, m.end_col) == \
+                               (promotion_move_pending.start_row, promotion_move_pending.start_col,
+                                promotion_move_pending.end_row, promotion_move_pending.end_col):
+                                promotion_move_pending = m
+                                break
 
                         start_pos = (promotion_move_pending.start_col * visualizer.SQUARE_SIZE, promotion_move_pending.start_row * visualizer.SQUARE_SIZE)
                         end_pos = (promotion_move_pending.end_col * visualizer.SQUARE_SIZE, promotion_move_pending.end_row * visualizer.SQUARE_SIZE)
@@ -239,11 +260,14 @@ def play_game(mode, ai_depth, visualizer, player_wants_black=False):
             # Start AI thinking in background thread
             ai_result = {'move': None, 'done': False, 'error': None}
             ai_thread = None
+            ai_kwargs = {'remaining_time': ai_remaining_time, 'increment': ai_increment}
+            ai_start_time = time.time()
             
             if mode == "player_vs_ai":
                 ai_thread = threading.Thread(
                     target=ai_thread_function, 
-                    args=(ai, True, 10.0, ai_result)
+                    args=(ai, True, 10.0, ai_result),
+                    kwargs=ai_kwargs
                 )
                 ai_thread.daemon = True  # Make thread exit when main program exits
                 ai_thread.start()
@@ -252,7 +276,8 @@ def play_game(mode, ai_depth, visualizer, player_wants_black=False):
                    (not game.white_to_move and ai_color == 'b'):
                     ai_thread = threading.Thread(
                         target=ai_thread_function, 
-                        args=(ai, True, 10.0, ai_result)
+                        args=(ai, True, 10.0, ai_result),
+                        kwargs=ai_kwargs
                     )
                     ai_thread.daemon = True
                     ai_thread.start()
@@ -301,6 +326,14 @@ def play_game(mode, ai_depth, visualizer, player_wants_black=False):
             
             # Get the move from the result container
             move = ai_result['move']
+
+            if ai_thread is not None and ai_remaining_time is not None:
+                ai_remaining_time += ai_increment - (time.time() - ai_start_time)
+                if ai_remaining_time <= 0:
+                    print("AI clock ran out; continuing with the minimum budget.")
+                    ai_remaining_time = 0.1
+                else:
+                    print(f"AI clock: {ai_remaining_time:.1f}s left")
             
             if move:
                 start_pos = (move.start_col * visualizer.SQUARE_SIZE, move.start_row * visualizer.SQUARE_SIZE)
@@ -308,6 +341,9 @@ def play_game(mode, ai_depth, visualizer, player_wants_black=False):
                 animating_piece = (start_pos, end_pos, move.piece_moved, 0)
                 
                 game.make_move(move)
+                if mode == "player_vs_ai":
+                    # Think on the player's time about the reply the search expects.
+                    ai.start_pondering()
                 
                 selected_square = ()
                 player_clicks = []
@@ -332,11 +368,13 @@ def play_game(mode, ai_depth, visualizer, player_wants_black=False):
 
              pygame.display.flip() 
 
+    if ai:
+        ai.close()
     print("Exiting game loop.")
     return result 
 
 
-def main():
+def main(ai_clock=None):
     visualizer = ChessVisualizer()
     while True:
         mode = None
@@ -443,7 +481,8 @@ def main():
         else:
              print(f"Starting Game: Mode={mode}")
 
-        result = play_game(mode, ai_depth, visualizer, player_wants_black=player_wants_black_flag if "ai" in mode else False)
+        result = play_game(mode, ai_depth, visualizer, player_wants_black=player_wants_black_flag if "ai" in mode else False,
+                           ai_clock=ai_clock)
 
 
         if result == 'quit': 
@@ -455,26 +494,29 @@ def main():
             time.sleep(1) 
     visualizer.close()
 
-def evaluate_performance(depths_to_test=[2, 3, 4], num_moves_per_depth=10):
+def evaluate_performance(depths_to_test=[2, 3, 4], num_moves_per_depth=10, workers=1):
     """
     Runs the AI at specified depths for a number of moves and records performance metrics.
     """
     print("\n--- Starting AI Performance Evaluation ---")
     print(f"Testing depths: {depths_to_test}")
-    print(f"Moves per depth: {num_moves_per_depth}\n")
+    print(f"Moves per depth: {num_moves_per_depth}")
+    print(f"Search processes: {workers}\n")
 
     results = {} 
 
     for depth in depths_to_test:
         print(f"--- Evaluating Depth {depth} ---")
-        game = GameState()
-        ai = ChessAI(game, max_depth=depth, color='w')
+        # Headless, so the faster bitboard backend; the GUI keeps the list board.
+        game = GameState(backend='bitboard')
+        ai = ChessAI(game, max_depth=depth, color='w', workers=workers)
         max_time_seconds_per_move = 180.0 
 
         times = []
         nodes = []
         q_nodes = []
         tt_hits = []
+        tt_usage = []
         moves_evaluated_count = 0
 
         for i in range(num_moves_per_depth * 2):
@@ -506,6 +548,7 @@ def evaluate_performance(depths_to_test=[2, 3, 4], num_moves_per_depth=10):
                     nodes.append(current_nodes)
                     q_nodes.append(current_q_nodes)
                     tt_hits.append(current_tt_hits)
+                    tt_usage.append(ai.transposition_table.usage())
                     moves_evaluated_count += 1
                 else:
                      print("  AI failed to find a move unexpectedly.")
@@ -527,22 +570,27 @@ def evaluate_performance(depths_to_test=[2, 3, 4], num_moves_per_depth=10):
             if is_ai_turn and moves_evaluated_count >= num_moves_per_depth:
                 break
 
+        ai.close()
+
         if times: 
             avg_time = sum(times) / len(times)
             avg_nodes = sum(n for n in nodes if isinstance(n, (int, float))) / len(nodes) if nodes else 0
             avg_q_nodes = sum(qn for qn in q_nodes if isinstance(qn, (int, float))) / len(q_nodes) if q_nodes else 0
             avg_tt_hits = sum(tth for tth in tt_hits if isinstance(tth, (int, float))) / len(tt_hits) if tt_hits else 0
+            avg_tt_usage = sum(tt_usage) / len(tt_usage) if tt_usage else 0
 
             results[depth] = {
                 'avg_time': avg_time,
                 'avg_nodes': avg_nodes,
                 'avg_q_nodes': avg_q_nodes,
                 'avg_tt_hits': avg_tt_hits,
+                'avg_tt_usage': avg_tt_usage,
                 'moves_evaluated': len(times)
             }
         else: 
              results[depth] = {
-                'avg_time': 0, 'avg_nodes': 0, 'avg_q_nodes': 0, 'avg_tt_hits': 0, 'moves_evaluated': 0
+                'avg_time': 0, 'avg_nodes': 0, 'avg_q_nodes': 0, 'avg_tt_hits': 0, 'avg_tt_usage': 0,
+                'moves_evaluated': 0
             }
 
         print(f"--- Depth {depth} Summary ---")
@@ -552,29 +600,34 @@ def evaluate_performance(depths_to_test=[2, 3, 4], num_moves_per_depth=10):
              print(f"  Avg Nodes: {results[depth]['avg_nodes']:.1f}")
              print(f"  Avg QNodes: {results[depth]['avg_q_nodes']:.1f}")
              print(f"  Avg TT Hits: {results[depth]['avg_tt_hits']:.1f}")
+             print(f"  Avg TT Usage: {results[depth]['avg_tt_usage'] * 100:.2f}%")
         print("-" * 25)
     print("\n--- Overall Performance Results ---")
-    print("| Depth | Avg Time (s) | Avg Nodes    | Avg QNodes   | Avg TT Hits  | Moves Eval |")
-    print("|-------|--------------|--------------|--------------|--------------|------------|")
+    print("| Depth | Avg Time (s) | Avg Nodes    | Avg QNodes   | Avg TT Hits  | TT Usage (%) | Moves Eval |")
+    print("|-------|--------------|--------------|--------------|--------------|--------------|------------|")
     # Body
     for depth in sorted(results.keys()):
         r = results[depth]
         print(f"| {depth:<5} | {r['avg_time']:<12.3f} | {r['avg_nodes']:<12.1f} | "
-              f"{r['avg_q_nodes']:<12.1f} | {r['avg_tt_hits']:<12.1f} | {r['moves_evaluated']:<10} |")
+              f"{r['avg_q_nodes']:<12.1f} | {r['avg_tt_hits']:<12.1f} | "
+              f"{r['avg_tt_usage'] * 100:<12.2f} | {r['moves_evaluated']:<10} |")
 
     print("\n--- Evaluation Complete ---")
     return results 
 
-def evaluate_vs_random(ai_depth, num_games=10, max_time_per_move=5.0, max_game_ply=300):
+def evaluate_vs_random(ai_depth, num_games=10, clock=(60.0, 1.0), max_game_ply=300):
+    """clock is the AI's (seconds, increment) per game; running out of it loses the game."""
     print(f"\n--- Starting Evaluation: AI Depth {ai_depth} vs Random ({num_games} games) ---")
+    print(f"AI clock: {clock[0]:g}s + {clock[1]:g}s per move")
 
     win_times = []
     win_ply_counts = []
     ai_wins = 0
+    ai_flags = 0
     draws = 0
 
     for game_idx in range(num_games):
-        game = GameState()
+        game = GameState(backend='bitboard')
         ai_color = 'w' if game_idx % 2 == 0 else 'b'
         ai = ChessAI(game, max_depth=ai_depth, color=ai_color)
         use_id = True
@@ -583,6 +636,8 @@ def evaluate_vs_random(ai_depth, num_games=10, max_time_per_move=5.0, max_game_p
         start_game_time = time.time()
         game_over = False
         outcome = None
+        remaining_time, increment = clock
+        flagged = False
 
         while len(game.move_log) <= max_game_ply:
             if game.checkmate or game.stalemate:
@@ -594,8 +649,14 @@ def evaluate_vs_random(ai_depth, num_games=10, max_time_per_move=5.0, max_game_p
 
             move = None
             if is_ai_turn:
+                move_start_time = time.time()
                 move = ai.get_best_move(use_iterative_deepening=use_id,
-                                        max_time_seconds=max_time_per_move)
+                                        remaining_time=remaining_time, increment=increment)
+                remaining_time -= time.time() - move_start_time
+                if remaining_time <= 0:
+                    flagged = True
+                    break
+                remaining_time += increment
             else: 
                 move = random_move(game)
 
@@ -609,7 +670,11 @@ def evaluate_vs_random(ai_depth, num_games=10, max_time_per_move=5.0, max_game_p
         game_duration = end_game_time - start_game_time
         ply_count = len(game.move_log)
 
-        if game.checkmate:
+        if flagged:
+            outcome = 'random_win'
+            ai_flags += 1
+            print(f"  Game {game_idx + 1}: AI Lost on Time after {ply_count} ply ({game_duration:.2f}s)")
+        elif game.checkmate:
          
             winner_color = 'b' if game.white_to_move else 'w'
             if winner_color == ai_color:
@@ -643,7 +708,7 @@ def evaluate_vs_random(ai_depth, num_games=10, max_time_per_move=5.0, max_game_p
     print(f"Total Games: {num_games}")
     print(f"AI Wins: {ai_wins} ({ai_wins / num_games * 100:.1f}%)")
     print(f"Draws: {draws}")
-    print(f"Random Wins: {num_games - ai_wins - draws}")
+    print(f"Random Wins: {num_games - ai_wins - draws} (AI lost on time: {ai_flags})")
     if ai_wins > 0:
         print(f"Average Time per AI Win: {avg_win_time:.2f} seconds")
         print(f"Average Ply Count per AI Win: {avg_win_ply:.1f}")
@@ -657,12 +722,75 @@ def evaluate_vs_random(ai_depth, num_games=10, max_time_per_move=5.0, max_game_p
         'avg_win_time': avg_win_time,
         'avg_win_ply': avg_win_ply,
         'draws': draws,
+        'ai_flags': ai_flags,
         'total_games': num_games
     }
 
-   
+# Reference positions with published perft node counts, indexed by depth - 1.
+PERFT_SUITE = [
+    ("Start position", "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+     [20, 400, 8902, 197281, 4865609]),
+    ("Kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+     [48, 2039, 97862, 4085603]),
+    ("Position 3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+     [14, 191, 2812, 43238, 674624]),
+    ("Position 4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+     [6, 264, 9467, 422333]),
+    ("Position 5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+     [44, 1486, 62379, 2103487]),
+    ("Position 6", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+     [46, 2079, 89890, 3894594]),
+]
+
+def run_perft_suite(max_depth=3, backend='bitboard'):
+    """
+    Runs perft on the reference positions, checking node counts and reporting nodes per second.
+    """
+    print("\n--- Starting Perft Suite ---")
+    print(f"Max depth: {max_depth}")
+    print(f"Board backend: {backend}\n")
+
+    failures = 0
+    total_nodes = 0
+    total_time = 0.0
+
+    for name, fen, expected_counts in PERFT_SUITE:
+        print(f"--- {name} ---")
+        for depth, expected in enumerate(expected_counts[:max_depth], start=1):
+            game = GameState.from_fen(fen, backend=backend)
+            start_time = time.time()
+            nodes = game.perft(depth)
+            elapsed = time.time() - start_time
+
+            total_nodes += nodes
+            total_time += elapsed
+            nps = nodes / elapsed if elapsed > 0 else 0
+            status = "OK" if nodes == expected else "FAIL"
+            if nodes != expected:
+                failures += 1
+            print(f"  Depth {depth}: {nodes:>10} nodes (expected {expected:>10}) {status:<4} "
+                  f"{elapsed:8.3f}s {nps:>12,.0f} nps")
+
+    print("\n--- Perft Summary ---")
+    print(f"Total Nodes: {total_nodes}")
+    print(f"Total Time: {total_time:.3f}s")
+    if total_time > 0:
+        print(f"Nodes per Second: {total_nodes / total_time:,.0f}")
+    print(f"Failures: {failures}")
+    print("-" * 28)
+    return failures == 0
 
 if __name__ == "__main__":
+    ai_clock = None
+    if '--clock' in sys.argv:
+        clock_index = sys.argv.index('--clock')
+        try:
+            ai_clock = parse_clock(sys.argv[clock_index + 1])
+        except (IndexError, ValueError):
+            print("Invalid clock. Use seconds+increment (e.g., --clock 300+2).")
+            sys.exit(1)
+        del sys.argv[clock_index:clock_index + 2]
+
     if len(sys.argv) > 1 and sys.argv[1] == '--eval-random':
         target_depth = 2 
         num_sim_games = 10
@@ -674,10 +802,25 @@ if __name__ == "__main__":
             except ValueError: print(f"Invalid number of games, using {num_sim_games}.")
 
         print(f"Running AI Depth {target_depth} vs Random for {num_sim_games} games...")
-        results = evaluate_vs_random(ai_depth=target_depth, num_games=num_sim_games)
+        if ai_clock is not None:
+            results = evaluate_vs_random(ai_depth=target_depth, num_games=num_sim_games, clock=ai_clock)
+        else:
+            results = evaluate_vs_random(ai_depth=target_depth, num_games=num_sim_games)
         print("Random evaluation finished. Exiting.")
         sys.exit()
 
+    elif len(sys.argv) > 1 and sys.argv[1] == '--perft':
+        perft_depth = 3
+        perft_backend = 'bitboard'
+        if len(sys.argv) > 2:
+            try: perft_depth = int(sys.argv[2])
+            except ValueError: print(f"Invalid depth, using {perft_depth}.")
+        if len(sys.argv) > 3:
+            if sys.argv[3] in ('list', 'bitboard'): perft_backend = sys.argv[3]
+            else: print(f"Invalid backend, using {perft_backend}.")
+        passed = run_perft_suite(max_depth=perft_depth, backend=perft_backend)
+        sys.exit(0 if passed else 1)
+
     elif len(sys.argv) > 1 and sys.argv[1] == '--evaluate':
         print("Running Performance Evaluation...")
         # Defaults
@@ -693,12 +836,19 @@ if __name__ == "__main__":
                  eval_moves = int(sys.argv[3])
              except ValueError:
                  print("Invalid number of moves. Use an integer. Using default.")
-        results = evaluate_performance(depths_to_test=eval_depths, num_moves_per_depth=eval_moves)
+        eval_workers = 1
+        if len(sys.argv) > 4:
+             try:
+                 eval_workers = int(sys.argv[4])
+             except ValueError:
+                 print("Invalid number of workers. Use an integer. Using default.")
+        results = evaluate_performance(depths_to_test=eval_depths, num_moves_per_depth=eval_moves,
+                                       workers=eval_workers)
         print("Performance evaluation finished. Exiting.")
         sys.exit() 
 
     else:
-        main()
+        main(ai_clock=ai_clock)
         # print("Starting Interactive Game...")
         # visualizer = ChessVisualizer()
         # while True:
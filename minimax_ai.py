@@ -1,9 +1,16 @@
+import copy
 import math
 import random
 import time
 import sys
+from bitboard import PIECE_CODES
 from game_state import GameState, Move
+from time_manager import TimeManager
+from transposition_table import TranspositionTable
+import threading
 import traceback 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
 
 MIDDLEGAME_THRESHOLD = 20
 ENDGAME_THRESHOLD = 10
@@ -14,6 +21,26 @@ TT_EXACT = 0
 TT_LOWERBOUND = 1
 TT_UPPERBOUND = 2
 
+MAX_PLY = 64
+
+NULL_MOVE_REDUCTION = 2
+NULL_MOVE_MIN_DEPTH = 3
+
+LMR_MIN_DEPTH = 3
+LMR_FULL_DEPTH_MOVES = 3
+# Reduction in plies for a late quiet move, indexed by [depth][moves already searched].
+LMR_REDUCTIONS = [[int(0.75 + math.log(depth) * math.log(move_number) / 2.25) if depth and move_number else 0
+                   for move_number in range(64)] for depth in range(MAX_PLY)]
+
+# Static-eval margins, in centipawns, for skipping work near the leaves.
+FUTILITY_MARGINS = [0, 200, 350]
+REVERSE_FUTILITY_MARGIN = 120
+REVERSE_FUTILITY_MAX_DEPTH = 3
+DELTA_MARGIN = 200
+
+ASPIRATION_WINDOW = 50
+ASPIRATION_MAX_WINDOW = 800
+
 PAWN_TABLE = [
     [0,  0,  0,  0,  0,  0,  0,  0],
     [50, 50, 50, 50, 50, 50, 50, 50],
@@ -116,7 +143,8 @@ KING_SAFETY_ATTACK_PENALTY = -50
 
 
 class ChessAI:
-    def __init__(self, game: GameState, max_depth: int, color: str):
+    def __init__(self, game: GameState, max_depth: int, color: str, tt_size_mb: float = 16, workers: int = 1,
+                 split_root: bool = False, shared_table_name: str = None):
         self.game = game
         self.max_depth = max_depth
         self.ai_player_color = color
@@ -127,28 +155,77 @@ class ChessAI:
         self.nodes_visited = 0
         self.q_nodes_visited = 0
         self.tt_hits = 0
-        self.transposition_table = {}
+        # With workers > 1 the table lives in shared memory so helper processes can fill it too.
+        self.workers = max(1, workers)
+        # Parallel mode for workers > 1: Lazy SMP by default, or split_root to farm out root moves.
+        self.split_root = split_root
+        self.transposition_table = TranspositionTable(tt_size_mb, shared=self.workers > 1, name=shared_table_name)
+        self.executor = None
+        self.stop_signal = None
+        self.helper_index = 0
+        self.completed_depth = 0
+        self.best_score = 0
+        self.stop_requested = False
+        self.ponder_ai = None
+        self.ponder_move = None
+        self.ponder_key = None
+        self.ponder_start_time = 0
+        self.ponder_thread = None
+        self.ponder_result = {}
+        # Set on the copy that ponders; it leaves the shared history and table generation alone.
+        self.is_ponder_search = False
+        self.killer_moves = [[None, None] for _ in range(MAX_PLY)]
+        self.history = {piece: [0] * 64 for piece in PIECE_CODES}
+        self.counter_moves = {piece: [None] * 64 for piece in PIECE_CODES}
+        # Plies at which the search passed the turn, and so added nothing to move_log.
+        self.null_move_plies = [False] * MAX_PLY
+        self.root_move_scores = {}
+        self.principal_variation = []
         self.timeout_occurred = False
 
-    def get_best_move(self, use_iterative_deepening=True, max_time_seconds=10.0):
+    def get_best_move(self, use_iterative_deepening=True, max_time_seconds=10.0, remaining_time=None, increment=0.0):
+        """Searches for a move within max_time_seconds, or within a budget taken from remaining_time."""
         self.move_count = len(self.game.move_log)
         self.nodes_visited = 0
         self.q_nodes_visited = 0
         self.tt_hits = 0
         self.timeout_occurred = False
+        self.killer_moves = [[None, None] for _ in range(MAX_PLY)]
+        self.root_move_scores = {}
+        self.principal_variation = []
         best_move = None
 
         current_valid_moves = self.game.get_valid_moves()
         if self.game.checkmate or self.game.stalemate:
+            self.stop_pondering()
             return None
         if not current_valid_moves:
+             self.stop_pondering()
              return None
 
+        if remaining_time is not None:
+            piece_count = sum(len(squares) for squares in self.game.piece_squares.values())
+            time_manager = TimeManager.from_clock(remaining_time, increment, piece_count)
+        else:
+            time_manager = TimeManager.fixed(max_time_seconds)
+
+        if self.ponder_thread is not None:
+            pondered_move = self.finish_pondering(time_manager.soft_limit)
+            if pondered_move is not None:
+                return pondered_move
+
+        # Only now that no ponder search is writing to them.
+        if not self.is_ponder_search:
+            self.age_history()
+            self.transposition_table.new_search()
+
         try:
-            if use_iterative_deepening:
-                best_move = self.iterative_deepening(max_time=max_time_seconds)
+            if use_iterative_deepening and self.workers > 1 and not self.split_root:
+                best_move = self.lazy_smp_search(time_manager.hard_limit, time_manager)
+            elif use_iterative_deepening:
+                best_move = self.iterative_deepening(time_manager=time_manager)
             else:
-                _, best_move = self.alphabeta_root(self.max_depth)
+                _, best_move, self.principal_variation = self.alphabeta_root(self.max_depth)
 
         except TimeoutError:
             pass
@@ -165,30 +242,40 @@ class ChessAI:
 
         return best_move
 
-    def iterative_deepening(self, max_time=5.0):
+    def iterative_deepening(self, max_time=5.0, time_manager=None):
+        if time_manager is None:
+            time_manager = TimeManager.fixed(max_time)
         self.start_time = time.time()
-        self.max_time = max_time
+        self.max_time = time_manager.hard_limit
        
         best_move_overall = None
-        self.transposition_table.clear()
+        previous_score = None
+        self.completed_depth = 0
 
         initial_moves = self.game.get_valid_moves()
         if not initial_moves: return None
 
-        for depth in range(1, self.max_depth + 1):
+        # Odd-numbered Lazy SMP helpers run one ply out of step with the main search.
+        for depth in range(1 + self.helper_index % 2, self.max_depth + 1):
             self.nodes_visited = 0
             self.q_nodes_visited = 0
             self.tt_hits = 0
             self.timeout_occurred = False
+            iteration_start = time.time()
 
             try:
-                current_score, current_best_move_this_depth = self.alphabeta_root(depth, initial_moves)
+                current_score, current_best_move_this_depth, pv = self.aspiration_search(depth, initial_moves, previous_score)
 
                 if self.timeout_occurred:
                     break
 
                 if current_best_move_this_depth:
                     best_move_overall = current_best_move_this_depth
+                    previous_score = current_score
+                    self.principal_variation = pv
+                    self.completed_depth = depth
+                    self.best_score = current_score
+                    time_manager.record_iteration(current_best_move_this_depth, time.time() - iteration_start)
                    
                     if abs(current_score) > PIECE_VALUES['k']:
                          break
@@ -197,7 +284,7 @@ class ChessAI:
                          best_move_overall = random.choice(initial_moves) if initial_moves else None
                      break
 
-                if time.time() - self.start_time > self.max_time * 0.95: 
+                if not time_manager.should_start_iteration(time.time() - self.start_time):
                     break
 
             except TimeoutError:
@@ -215,97 +302,448 @@ class ChessAI:
 
         return best_move_overall
 
+    def start_pondering(self):
+        """Searches the expected reply in a background thread; returns False if there is none."""
+        self.stop_pondering()
+        pv = self.principal_variation
+        if len(pv) < 2 or not self.game.move_log or self.game.move_log[-1].move_id != pv[0].move_id:
+            return False
+        expected_reply = self.game.move_from_id(pv[1].move_id)
+        if expected_reply is None or expected_reply not in self.game.get_valid_moves():
+            return False
+
+        ponder_game = GameState.from_snapshot(self.game.to_snapshot())
+        ponder_game.make_move(ponder_game.move_from_id(expected_reply.move_id))
+        ponder_ai = copy.copy(self)
+        ponder_ai.game = ponder_game
+        ponder_ai.workers = 1
+        ponder_ai.executor = None
+        ponder_ai.stop_signal = None
+        ponder_ai.ponder_thread = None
+        ponder_ai.is_ponder_search = True
+        ponder_ai.null_move_plies = [False] * MAX_PLY
+
+        self.ponder_ai = ponder_ai
+        self.ponder_move = expected_reply
+        self.ponder_key = ponder_game.zobrist_key
+        self.ponder_result = {}
+        self.ponder_start_time = time.time()
+
+        def ponder():
+            self.ponder_result['move'] = ponder_ai.get_best_move(max_time_seconds=float('inf'))
+
+        self.ponder_thread = threading.Thread(target=ponder, daemon=True)
+        self.ponder_thread.start()
+        return True
+
+    def finish_pondering(self, max_time_seconds):
+        """On a ponder hit, lets the search use what is left of max_time_seconds and returns its move."""
+        last_move = self.game.move_log[-1] if self.game.move_log else None
+        if last_move is None or last_move.move_id != self.ponder_move.move_id or \
+           self.game.zobrist_key != self.ponder_key:
+            self.stop_pondering()
+            return None
+
+        # Time spent pondering counts against the budget, so a long ponder answers at once.
+        ponder_elapsed = time.time() - self.ponder_start_time
+        self.ponder_thread.join(timeout=max(0.0, max_time_seconds - ponder_elapsed))
+        ponder_ai = self.ponder_ai
+        self.stop_pondering()
+        move = self.ponder_result.get('move')
+        if move is None:
+            return None
+        self.nodes_visited = ponder_ai.nodes_visited
+        self.q_nodes_visited = ponder_ai.q_nodes_visited
+        self.tt_hits = ponder_ai.tt_hits
+        self.timeout_occurred = ponder_ai.timeout_occurred
+        self.completed_depth = ponder_ai.completed_depth
+        self.best_score = ponder_ai.best_score
+        self.principal_variation = ponder_ai.principal_variation
+        # The ponder game is a copy; hand back the equivalent move object from the real game.
+        return self.game.move_from_id(move.move_id)
+
+    def stop_pondering(self):
+        if self.ponder_thread is None:
+            return
+        self.ponder_ai.stop_requested = True
+        self.ponder_thread.join()
+        self.ponder_thread = None
+        self.ponder_ai = None
+        self.ponder_move = None
+        self.ponder_key = None
+
+    def lazy_smp_search(self, max_time, time_manager=None):
+        """Runs iterative deepening here and in workers - 1 helper processes on the shared table."""
+        self.start_pool(self.workers - 1)
+        snapshot = self.game.to_snapshot()
+        table = self.transposition_table
+        helpers = [self.executor.submit(_lazy_smp_helper, snapshot, self.ai_player_color, self.max_depth, max_time,
+                                        table.name, table.size_mb, table.generation, self.stop_signal.name, index)
+                   for index in range(1, self.workers)]
+        try:
+            best_move = self.iterative_deepening(max_time=max_time, time_manager=time_manager)
+        finally:
+            self.stop_signal.buf[0] = 1
+
+        best_depth = self.completed_depth
+        for helper in helpers:
+            try:
+                depth, score, move_id = helper.result()
+            except Exception as e:
+                print(f"Lazy SMP helper failed: {e}")
+                continue
+            if depth > best_depth and move_id:
+                move = self.game.move_from_id(move_id)
+                if move is not None and move in self.game.get_valid_moves():
+                    best_move, best_depth, self.best_score = move, depth, score
+        self.completed_depth = best_depth
+        return best_move
+
+    def start_pool(self, max_workers):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=max_workers)
+            self.stop_signal = shared_memory.SharedMemory(create=True, size=1)
+        self.stop_signal.buf[0] = 0
+
+    def close(self):
+        """Stops pondering and helper processes and frees shared memory."""
+        self.stop_pondering()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if self.stop_signal is not None:
+            self.stop_signal.close()
+            self.stop_signal.unlink()
+            self.stop_signal = None
+        self.transposition_table.close(unlink=True)
+
+    def search_time_exceeded(self):
+        if self.stop_requested:
+            return True
+        if self.stop_signal is not None and self.stop_signal.buf[0]:
+            return True
+        return self.start_time > 0 and time.time() - self.start_time > self.max_time
+
+    def aspiration_search(self, depth, initial_moves, previous_score):
+        """Searches the root in a narrow window around the previous depth's score, widening on failure."""
+        if previous_score is None or math.isinf(previous_score):
+            return self.alphabeta_root(depth, initial_moves)
+
+        window = ASPIRATION_WINDOW
+        alpha = previous_score - window
+        beta = previous_score + window
+        while True:
+            score, best_move, pv = self.alphabeta_root(depth, initial_moves, alpha, beta)
+            window *= 2
+            wide = window > ASPIRATION_MAX_WINDOW or math.isinf(score)
+            if score <= alpha and alpha != -float('inf'):
+                alpha = -float('inf') if wide else previous_score - window
+            elif score >= beta and beta != float('inf'):
+                beta = float('inf') if wide else previous_score + window
+            else:
+                return score, best_move, pv
+
     def fallback_move_selection(self, valid_moves):
         if not valid_moves: return None
         capture_moves = []
         other_moves = []
         for m in valid_moves:
             if m.piece_captured != '--':
-                score = PIECE_VALUES.get(m.piece_captured[1], 0) * 10 - PIECE_VALUES.get(m.piece_moved[1], 0)
+                score = self.game.static_exchange_evaluation(m)
                 capture_moves.append((score, m))
             else:
                 other_moves.append(m)
         capture_moves.sort(key=lambda x: x[0], reverse=True)
 
-        if capture_moves:
+        # A capture that loses material in the exchange goes after every quiet move.
+        if capture_moves and (capture_moves[0][0] >= 0 or not other_moves):
             selected = capture_moves[0][1]
             return selected
         else:
             selected = random.choice(other_moves)
             return selected
 
-    def order_moves(self, moves):
+    def order_moves(self, moves, hash_move=None):
+        return [move for score, move in self.score_moves(moves, hash_move)]
+
+    def score_moves(self, moves, hash_move=None):
+        """Returns (score, move) pairs, best first, with losing captures sorted after quiet moves."""
+        hash_id = hash_move.move_id if hash_move is not None else None
         move_scores = []
         for move in moves:
             score = 0
-            if move.piece_captured != '--':
-                 score += 10 * PIECE_VALUES.get(move.piece_captured[1], 0) - PIECE_VALUES.get(move.piece_moved[1], 0)
-                 score += 1000
-
-            if move.is_pawn_promotion:
-                 score += PIECE_VALUES['q']
-
+            if move.move_id == hash_id:
+                score += 1000000
+            if move.piece_captured != '--' or move.is_pawn_promotion:
+                exchange = self.game.static_exchange_evaluation(move)
+                if exchange < 0:
+                    score += exchange - 1000
+                else:
+                    if move.piece_captured != '--':
+                        score += 10 * PIECE_VALUES.get(move.piece_captured[1], 0) - PIECE_VALUES.get(move.piece_moved[1], 0)
+                        score += 1000
+                    if move.is_pawn_promotion:
+                        score += PIECE_VALUES[move.promotion_choice]
 
             move_scores.append((score, move))
 
         move_scores.sort(key=lambda x: x[0], reverse=True)
-        return [move for score, move in move_scores]
+        return move_scores
+
+    def staged_moves(self, hash_move, ply):
+        """Yields legal moves stage by stage: hash move, good captures, killers, quiets, bad captures."""
+        board = self.game.board
+        hash_id = None
+        if hash_move is not None and board[hash_move.start_row][hash_move.start_col] == hash_move.piece_moved and \
+           (hash_move.is_en_passant or board[hash_move.end_row][hash_move.end_col] == hash_move.piece_captured):
+            hash_id = hash_move.move_id
+            yield hash_move
+
+        losing_captures = []
+        for score, move in self.score_moves(self.game.generate_legal_moves(quiets=False)):
+            if move.move_id == hash_id:
+                continue
+            if score < 0:
+                losing_captures.append(move)
+            else:
+                yield move
+
+        quiet_moves = self.game.generate_legal_moves(captures=False)
+        searched_ids = {hash_id}
+        for refutation in self.killer_moves[ply] + [self.get_counter_move(ply)]:
+            if refutation is None or refutation.move_id in searched_ids:
+                continue
+            for move in quiet_moves:
+                if move.move_id == refutation.move_id:
+                    searched_ids.add(move.move_id)
+                    yield move
+                    break
+
+        history = self.history
+        quiet_moves.sort(key=lambda move: history[move.piece_moved][move.end_row * 8 + move.end_col], reverse=True)
+        for move in quiet_moves:
+            if move.move_id not in searched_ids:
+                yield move
+
+        yield from losing_captures
 
-    def alphabeta_root(self, depth, initial_moves=None):
+    def has_non_pawn_material(self):
+        # Null-move pruning is unsound in zugzwang, which is mostly a king-and-pawns affair.
+        color = 'w' if self.game.white_to_move else 'b'
+        piece_squares = self.game.piece_squares
+        return any(piece_squares[color + piece_type] for piece_type in 'nbrq')
+
+    def previous_move(self, ply):
+        # The move that led to this ply; None after a null move, where move_log[-1] is a ply older.
+        if not self.game.move_log or ply > 0 and self.null_move_plies[ply - 1]:
+            return None
+        return self.game.move_log[-1]
+
+    def get_counter_move(self, ply):
+        last_move = self.previous_move(ply)
+        if last_move is None:
+            return None
+        return self.counter_moves[last_move.piece_moved][last_move.end_row * 8 + last_move.end_col]
+
+    def store_quiet_cutoff(self, move, ply, depth):
+        """Records a quiet move that caused a beta cutoff as killer, history and counter move."""
+        if move.piece_captured != '--' or move.is_pawn_promotion:
+            return
+        killers = self.killer_moves[ply]
+        if killers[0] is None or killers[0].move_id != move.move_id:
+            killers[1] = killers[0]
+            killers[0] = move
+        self.history[move.piece_moved][move.end_row * 8 + move.end_col] += depth * depth
+        last_move = self.previous_move(ply)
+        if last_move is not None:
+            self.counter_moves[last_move.piece_moved][last_move.end_row * 8 + last_move.end_col] = move
+
+    def age_history(self):
+        # Halve rather than clear, so the previous search still guides ordering but fades out.
+        for scores in self.history.values():
+            for sq in range(64):
+                scores[sq] >>= 1
+        # A counter move has no score to fade, and a reply from several moves back is stale: clear them.
+        for replies in self.counter_moves.values():
+            replies[:] = [None] * 64
+
+    def alphabeta_root(self, depth, initial_moves=None, alpha=-float('inf'), beta=float('inf')):
+        """Returns (score, best move, principal variation) for the side to move."""
         if initial_moves is None:
              initial_moves = self.game.get_valid_moves()
 
-        if not initial_moves: return (-float('inf') if self.game.white_to_move else float('inf')), None
-        if self.game.stalemate: return 0, None
+        if not initial_moves: return -float('inf'), None, []
+        if self.game.stalemate: return 0, None, []
 
-        ordered_moves = self.order_moves(initial_moves)
+        position_key = self.game._get_position_key()
+        ordered_moves = self.order_root_moves(initial_moves, position_key)
         best_move_found = ordered_moves[0]
-        alpha = -float('inf')
-        beta = float('inf')
+        best_score = -float('inf')
+        original_alpha = alpha
+        move_scores = {}
 
-        if self.game.white_to_move:
-            max_eval = -float('inf')
-            for move in ordered_moves:
+        if self.split_root and self.workers > 1 and depth > 1 and len(ordered_moves) > 1:
+            best_score, best_move_found, move_scores = self.split_root_moves(depth, ordered_moves, alpha, beta)
+        else:
+            for move_number, move in enumerate(ordered_moves):
                 self.game.make_move(move)
-                current_eval = self.alphabeta(depth - 1, alpha, beta)
+                current_eval = self.principal_variation_child(depth - 1, alpha, beta, 1,
+                                                              move_number == 0 or alpha == -float('inf'))
                 self.game.undo_move()
 
                 if self.timeout_occurred: raise TimeoutError("Timeout")
 
-                if current_eval > max_eval:
-                    max_eval = current_eval
+                move_scores[move.move_id] = current_eval
+                if current_eval > best_score:
+                    best_score = current_eval
                     best_move_found = move
                 alpha = max(alpha, current_eval)
+                if alpha >= beta:
+                    break
 
-            return max_eval, best_move_found
+        if best_score <= original_alpha:
+            flag = TT_UPPERBOUND
+        elif best_score >= beta:
+            flag = TT_LOWERBOUND
         else:
-            min_eval = float('inf')
-            for move in ordered_moves:
-                self.game.make_move(move)
-                current_eval = self.alphabeta(depth - 1, alpha, beta)
-                self.game.undo_move()
+            flag = TT_EXACT
+            self.root_move_scores = move_scores
+        self.transposition_table.store(position_key, best_score, depth, flag, best_move_found.move_id)
+        return best_score, best_move_found, self.get_principal_variation(depth)
+
+    def split_root_moves(self, depth, ordered_moves, alpha, beta):
+        """Scores root moves in the process pool; returns (best score, best move, scores by move_id)."""
+        self.start_pool(self.workers)
+        best_move = ordered_moves[0]
+        self.game.make_move(best_move)
+        best_score = self.principal_variation_child(depth - 1, alpha, beta, 1, True)
+        self.game.undo_move()
+        if self.timeout_occurred: raise TimeoutError("Timeout")
+        move_scores = {best_move.move_id: best_score}
+        alpha = max(alpha, best_score)
+        if alpha >= beta:
+            return best_score, best_move, move_scores
 
-                if self.timeout_occurred: raise TimeoutError("Timeout")
+        table = self.transposition_table
+        pending = {}
+        remaining_moves = iter(ordered_moves[1:])
 
-                if current_eval < min_eval:
-                    min_eval = current_eval
-                    best_move_found = move
-                beta = min(beta, current_eval)
+        def time_left():
+            return max(self.max_time - (time.time() - self.start_time), 0.001) if self.start_time > 0 else None
+
+        def submit(move, window_alpha, window_beta):
+            self.game.make_move(move)
+            snapshot = self.game.to_snapshot()
+            self.game.undo_move()
+            future = self.executor.submit(_search_root_move, snapshot, depth, window_alpha, window_beta,
+                                          self.ai_player_color, table.name, table.size_mb, table.generation,
+                                          self.stop_signal.name, time_left())
+            pending[future] = (move, window_alpha, window_beta)
+
+        def probe_next(alpha):
+            move = next(remaining_moves, None)
+            if move is not None:
+                submit(move, alpha, beta if alpha == -float('inf') else alpha + 1)
 
-            return min_eval, best_move_found
+        for _ in range(self.workers):
+            probe_next(alpha)
 
-    def alphabeta(self, depth, alpha, beta):
+        try:
+            while pending:
+                done, _ = wait(pending, timeout=time_left(), return_when=FIRST_COMPLETED)
+                if not done:
+                    self.timeout_occurred = True
+                    raise TimeoutError("Timeout")
+                for future in done:
+                    move, window_alpha, window_beta = pending.pop(future)
+                    score, nodes, timed_out = future.result()
+                    self.nodes_visited += nodes
+                    if timed_out:
+                        self.timeout_occurred = True
+                        raise TimeoutError("Timeout")
+                    if score >= window_beta and window_beta < beta:
+                        # Only a lower bound. Past the current alpha it earns the full window;
+                        # otherwise alpha has since risen above it, so probe again at the new alpha.
+                        submit(move, alpha, beta if score > alpha else alpha + 1)
+                        continue
+                    move_scores[move.move_id] = score
+                    if score > best_score:
+                        best_score = score
+                        best_move = move
+                    alpha = max(alpha, score)
+                    if alpha >= beta:
+                        return best_score, best_move, move_scores
+                    probe_next(alpha)
+        finally:
+            if pending:
+                # Stop searches still running for a result that no longer matters.
+                self.stop_signal.buf[0] = 1
+                for future in pending:
+                    future.cancel()
+                wait(pending)
+                self.stop_signal.buf[0] = 0
+        return best_score, best_move, move_scores
+
+    def order_root_moves(self, moves, position_key):
+        """Best move of the last completed iteration first, then the rest by the scores it gave them."""
+        tt_entry = self.transposition_table.probe(position_key)
+        hash_move = self.game.move_from_id(tt_entry[3]) if tt_entry and tt_entry[3] else None
+        ordered_moves = self.order_moves(moves, hash_move)
+        previous_scores = self.root_move_scores
+        if previous_scores:
+            hash_id = hash_move.move_id if hash_move is not None else None
+            # Stable sort, so moves without a previous score keep their capture order at the back.
+            ordered_moves.sort(key=lambda move: (move.move_id != hash_id,
+                                                 -previous_scores.get(move.move_id, -math.inf)))
+        if self.helper_index and len(ordered_moves) > 2:
+            # Lazy SMP helpers keep the best move first but start on different alternatives.
+            shift = self.helper_index % (len(ordered_moves) - 1)
+            ordered_moves[1:] = ordered_moves[1 + shift:] + ordered_moves[1:1 + shift]
+        return ordered_moves
+
+    def get_principal_variation(self, max_length):
+        """Follows the stored best moves from the current position through the transposition table."""
+        pv = []
+        seen_keys = set()
+        while len(pv) < max_length:
+            position_key = self.game._get_position_key()
+            tt_entry = self.transposition_table.probe(position_key)
+            if not tt_entry or not tt_entry[3] or position_key in seen_keys:
+                break
+            move = self.game.move_from_id(tt_entry[3])
+            if move is None or move not in self.game.generate_legal_moves():
+                break
+            seen_keys.add(position_key)
+            pv.append(move)
+            self.game.make_move(move)
+        for _ in pv:
+            self.game.undo_move()
+        return pv
+
+    def principal_variation_child(self, depth, alpha, beta, ply, full_window):
+        """Searches the position after a move, returning its score for the side that made it."""
+        if full_window:
+            return -self.alphabeta(depth, -beta, -alpha, ply)
+        score = -self.alphabeta(depth, -alpha - 1, -alpha, ply)
+        if alpha < score < beta and not self.timeout_occurred:
+            score = -self.alphabeta(depth, -beta, -alpha, ply)
+        return score
+
+    def alphabeta(self, depth, alpha, beta, ply, allow_null=True):
         self.nodes_visited += 1
 
         if self.nodes_visited % 2048 == 0:
-            if self.start_time > 0 and time.time() - self.start_time > self.max_time:
+            if self.search_time_exceeded():
                 self.timeout_occurred = True
                 return 0
 
         if self.timeout_occurred: return 0
 
         position_key = self.game._get_position_key()
-        tt_entry = self.transposition_table.get(position_key)
+        tt_entry = self.transposition_table.probe(position_key)
+        hash_move = None
+        if tt_entry and tt_entry[3]:
+            hash_move = self.game.move_from_id(tt_entry[3])
         if tt_entry and tt_entry[1] >= depth:
              self.tt_hits += 1
              score, stored_depth, flag, _ = tt_entry
@@ -322,137 +760,137 @@ class ChessAI:
         if depth <= 0:
             return self.quiescence_search(alpha, beta)
 
-        valid_moves = self.game.get_valid_moves()
-        if not valid_moves:
-            if self.game.checkmate:
-                 mate_score = float('inf') if not self.game.white_to_move else -float('inf')
-                 return mate_score
-            else:
-                 return self.evaluate_stalemate()
-
-        ordered_moves = self.order_moves(valid_moves)
-        best_move_for_tt = ordered_moves[0]
+        side_sign = 1 if self.game.white_to_move else -1
+        if self.game.is_threefold_repetition() or self.game.is_insufficient_material():
+            return self.evaluate_stalemate() * side_sign
+
+        in_check = self.game.is_in_check()
+        static_eval = None
+        if not in_check and depth <= REVERSE_FUTILITY_MAX_DEPTH:
+            static_eval = self.evaluate_board() * side_sign
+            # Far enough above beta that a shallow search is not going to bring it back down.
+            if beta - alpha <= 1 and static_eval - REVERSE_FUTILITY_MARGIN * depth >= beta:
+                return static_eval
+
+        futile = static_eval is not None and depth < len(FUTILITY_MARGINS) and alpha > -float('inf') and \
+                 static_eval + FUTILITY_MARGINS[depth] <= alpha
+
+        if allow_null and depth >= NULL_MOVE_MIN_DEPTH and beta < float('inf') and \
+           self.has_non_pawn_material() and not in_check:
+            # If passing the turn still fails high, a real move almost certainly would too.
+            null_ply = min(ply, MAX_PLY - 1)
+            self.null_move_plies[null_ply] = True
+            self.game.make_null_move()
+            null_score = -self.alphabeta(depth - 1 - NULL_MOVE_REDUCTION, -beta, -beta + 1, ply + 1, False)
+            self.game.undo_null_move()
+            self.null_move_plies[null_ply] = False
+            if self.timeout_occurred: return 0
+            if null_score >= beta:
+                return beta if math.isinf(null_score) else null_score
+
+        best_move_for_tt = None
+        best_score = -float('inf')
+        moves_searched = 0
+        ply = min(ply, MAX_PLY - 1)
 
         original_alpha = alpha
-        if self.game.white_to_move:
-            max_eval = -float('inf')
-            for move in ordered_moves:
-                self.game.make_move(move)
-                current_eval = self.alphabeta(depth - 1, alpha, beta)
-                self.game.undo_move()
-
-                if self.timeout_occurred: return 0
-
-                if current_eval > max_eval:
-                     max_eval = current_eval
-                     best_move_for_tt = move
-
-                alpha = max(alpha, current_eval)
-                if beta <= alpha:
-                    break
-            flag = TT_EXACT if max_eval > original_alpha and max_eval < beta else \
-                   TT_LOWERBOUND if max_eval >= beta else TT_UPPERBOUND
-            self.transposition_table[position_key] = (max_eval, depth, flag, best_move_for_tt)
-            return max_eval
-        else:
-            min_eval = float('inf')
-            for move in ordered_moves:
-                self.game.make_move(move)
-                current_eval = self.alphabeta(depth - 1, alpha, beta)
+        killer_ids = {killer.move_id for killer in self.killer_moves[ply] if killer is not None}
+        for move in self.staged_moves(hash_move, ply):
+            self.game.make_move(move)
+            late_quiet = (futile or depth >= LMR_MIN_DEPTH and moves_searched >= LMR_FULL_DEPTH_MOVES) and \
+                moves_searched > 0 and not in_check and move.piece_captured == '--' and \
+                not move.is_pawn_promotion and move.move_id not in killer_ids and not self.game.is_in_check()
+            if futile and late_quiet:
+                # Frontier node too far below alpha for a quiet move to matter.
                 self.game.undo_move()
+                continue
+            reduction = 0
+            if late_quiet and depth >= LMR_MIN_DEPTH and moves_searched >= LMR_FULL_DEPTH_MOVES:
+                reduction = min(LMR_REDUCTIONS[depth][min(moves_searched, 63)], depth - 2)
+            if reduction > 0:
+                # A late quiet move is first probed shallower; only one that beats alpha earns a full search.
+                current_eval = -self.alphabeta(depth - 1 - reduction, -alpha - 1, -alpha, ply + 1)
+                if current_eval > alpha and not self.timeout_occurred:
+                    current_eval = self.principal_variation_child(depth - 1, alpha, beta, ply + 1, False)
+            else:
+                current_eval = self.principal_variation_child(depth - 1, alpha, beta, ply + 1,
+                                                              moves_searched == 0 or alpha == -float('inf'))
+            self.game.undo_move()
+            moves_searched += 1
 
-                if self.timeout_occurred: return 0
+            if self.timeout_occurred: return 0
 
-                if current_eval < min_eval:
-                    min_eval = current_eval
-                    best_move_for_tt = move
+            if current_eval > best_score or best_move_for_tt is None:
+                 best_score = current_eval
+                 best_move_for_tt = move
 
-                beta = min(beta, current_eval)
-                if beta <= alpha:
-                    break
-            flag = TT_EXACT if min_eval > original_alpha and min_eval < beta else \
-                   TT_UPPERBOUND if min_eval <= original_alpha else TT_LOWERBOUND
-            self.transposition_table[position_key] = (min_eval, depth, flag, best_move_for_tt)
-            return min_eval
+            alpha = max(alpha, current_eval)
+            if alpha >= beta:
+                self.store_quiet_cutoff(move, ply, depth)
+                break
+        if moves_searched == 0:
+            return -float('inf') if self.game.in_check else self.evaluate_stalemate() * side_sign
+        flag = TT_UPPERBOUND if best_score <= original_alpha else \
+               TT_LOWERBOUND if best_score >= beta else TT_EXACT
+        self.transposition_table.store(position_key, best_score, depth, flag, best_move_for_tt.move_id)
+        return best_score
 
     def quiescence_search(self, alpha, beta, depth_limit=4):
         self.q_nodes_visited += 1
 
         if self.q_nodes_visited % 1024 == 0:
-             if self.start_time > 0 and time.time() - self.start_time > self.max_time:
+             if self.search_time_exceeded():
                  self.timeout_occurred = True
                  return 0
         if self.timeout_occurred: return 0
 
-        stand_pat_score = self.evaluate_board()
+        stand_pat_score = self.evaluate_board() * (1 if self.game.white_to_move else -1)
 
         if depth_limit <= 0:
             return stand_pat_score
 
-        if self.game.white_to_move:
-            alpha = max(alpha, stand_pat_score)
-        else:
-            beta = min(beta, stand_pat_score)
-
+        alpha = max(alpha, stand_pat_score)
         if alpha >= beta:
              return stand_pat_score
 
-        all_moves = self.game.get_valid_moves()
-        capture_moves = [m for m in all_moves if m.piece_captured != '--' or m.is_pawn_promotion]
-        ordered_captures = self.order_moves(capture_moves)
-
-        if self.game.white_to_move:
-            for move in ordered_captures:
-                self.game.make_move(move)
-                score = self.quiescence_search(alpha, beta, depth_limit - 1)
-                self.game.undo_move()
-
-                if self.timeout_occurred: return 0
-
-                alpha = max(alpha, score)
-                if beta <= alpha:
-                    break
-            return alpha
-
-        else:
-            for move in ordered_captures:
-                self.game.make_move(move)
-                score = self.quiescence_search(alpha, beta, depth_limit - 1)
-                self.game.undo_move()
-
-                if self.timeout_occurred: return 0
-
-                beta = min(beta, score)
-                if beta <= alpha:
-                    break
-            return beta
-
+        for move in self.game.get_capture_moves():
+            if not move.is_pawn_promotion and \
+               stand_pat_score + PIECE_VALUES[move.piece_captured[1]] + DELTA_MARGIN <= alpha:
+                # Delta pruning: even winning the piece outright cannot lift the score to alpha.
+                continue
+            if self.game.static_exchange_evaluation(move) < 0:
+                continue
+            self.game.make_move(move)
+            score = -self.quiescence_search(-beta, -alpha, depth_limit - 1)
+            self.game.undo_move()
+
+            if self.timeout_occurred: return 0
+
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                break
+        return alpha
 
-    def get_piece_counts_and_material(self, board):
+    def get_piece_counts_and_material(self):
         white_material = 0
         black_material = 0
         piece_count = 0
-        white_pawns = []
-        black_pawns = []
 
-        for r in range(8):
-            for c in range(8):
-                piece = board[r][c]
-                if piece != '--':
-                    piece_count += 1
-                    piece_type = piece[1]
-                    value = PIECE_VALUES.get(piece_type, 0)
-                    if piece[0] == 'w':
-                        white_material += value
-                        if piece_type == 'p': white_pawns.append(c)
-                    else:
-                        black_material += value
-                        if piece_type == 'p': black_pawns.append(c)
-        return white_material, black_material, piece_count, sorted(white_pawns), sorted(black_pawns)
+        for piece, squares in self.game.piece_squares.items():
+            if not squares: continue
+            piece_count += len(squares)
+            value = PIECE_VALUES.get(piece[1], 0) * len(squares)
+            if piece[0] == 'w':
+                white_material += value
+            else:
+                black_material += value
+        white_pawns = sorted(c for r, c in self.game.piece_squares['wp'])
+        black_pawns = sorted(c for r, c in self.game.piece_squares['bp'])
+        return white_material, black_material, piece_count, white_pawns, black_pawns
 
 
     def evaluate_stalemate(self):
-        white_mat, black_mat, _, _, _ = self.get_piece_counts_and_material(self.game.board)
+        white_mat, black_mat, _, _, _ = self.get_piece_counts_and_material()
         material_diff = white_mat - black_mat
 
         ai_perspective_diff = material_diff * self.ai_player_sign
@@ -467,7 +905,7 @@ class ChessAI:
 
     def evaluate_board(self):
         white_material, black_material, piece_count, white_pawns, black_pawns = \
-            self.get_piece_counts_and_material(self.game.board)
+            self.get_piece_counts_and_material()
         material_score = white_material - black_material
 
         if piece_count > MIDDLEGAME_THRESHOLD: game_phase = 'middle'
@@ -482,46 +920,44 @@ class ChessAI:
         white_king_pos = self.game.white_king_location
         black_king_pos = self.game.black_king_location
 
-        for r in range(8):
-            for c in range(8):
-                piece = self.game.board[r][c]
-                if piece != '--':
-                    piece_type = piece[1]
-                    piece_color = piece[0]
-                    color_sign = 1 if piece_color == 'w' else -1
-
-                    try:
-                        if piece_type == 'k':
-                             table = PIECE_POSITION_TABLES['k'][piece_color][game_phase]
-                             position_score += table[r][c] * color_sign
-                        else:
-                             table = PIECE_POSITION_TABLES[piece_type][piece_color]
-                             position_score += table[r][c] * color_sign
-                    except KeyError: pass
-                    except IndexError: pass  
-
-                    if (r, c) in [(2,2),(2,3),(2,4),(2,5), (3,2),(3,3),(3,4),(3,5), (4,2),(4,3),(4,4),(4,5), (5,2),(5,3),(5,4),(5,5)]:
-                        if piece_type in 'nbp':
-                           center_control_score += (CENTER_CONTROL_BONUS / 2) * color_sign
-                    if (r,c) in CENTER_SQUARES:
-                         if piece_type in 'nbp':
-                             center_control_score += (CENTER_CONTROL_BONUS / 2) * color_sign
-
-                    if piece_type == 'p':
-                        is_passed = True
-                        for check_r in range(r + color_sign, 8 if color_sign == 1 else -1, color_sign):
-                            if not (0 <= check_r < 8): break
-                            for check_c_offset in [-1, 0, 1]:
-                                check_c = c + check_c_offset
-                                if 0 <= check_c < 8:
-                                    opp_piece = self.game.board[check_r][check_c]
-                                    if opp_piece != '--' and opp_piece[0] != piece_color and opp_piece[1] == 'p':
-                                        is_passed = False
-                                        break
-                            if not is_passed: break
-                        if is_passed:
-                            rank_index = r if piece_color == 'b' else 7 - r
-                            pawn_structure_score += PASSED_PAWN_BONUS[rank_index] * color_sign
+        for piece, squares in self.game.piece_squares.items():
+            for r, c in squares:
+                piece_type = piece[1]
+                piece_color = piece[0]
+                color_sign = 1 if piece_color == 'w' else -1
+
+                try:
+                    if piece_type == 'k':
+                         table = PIECE_POSITION_TABLES['k'][piece_color][game_phase]
+                         position_score += table[r][c] * color_sign
+                    else:
+                         table = PIECE_POSITION_TABLES[piece_type][piece_color]
+                         position_score += table[r][c] * color_sign
+                except KeyError: pass
+                except IndexError: pass  
+
+                if (r, c) in [(2,2),(2,3),(2,4),(2,5), (3,2),(3,3),(3,4),(3,5), (4,2),(4,3),(4,4),(4,5), (5,2),(5,3),(5,4),(5,5)]:
+                    if piece_type in 'nbp':
+                       center_control_score += (CENTER_CONTROL_BONUS / 2) * color_sign
+                if (r,c) in CENTER_SQUARES:
+                     if piece_type in 'nbp':
+                         center_control_score += (CENTER_CONTROL_BONUS / 2) * color_sign
+
+                if piece_type == 'p':
+                    is_passed = True
+                    for check_r in range(r + color_sign, 8 if color_sign == 1 else -1, color_sign):
+                        if not (0 <= check_r < 8): break
+                        for check_c_offset in [-1, 0, 1]:
+                            check_c = c + check_c_offset
+                            if 0 <= check_c < 8:
+                                opp_piece = self.game.board[check_r][check_c]
+                                if opp_piece != '--' and opp_piece[0] != piece_color and opp_piece[1] == 'p':
+                                    is_passed = False
+                                    break
+                        if not is_passed: break
+                    if is_passed:
+                        rank_index = r if piece_color == 'b' else 7 - r
+                        pawn_structure_score += PASSED_PAWN_BONUS[rank_index] * color_sign
 
         wp_counts = {col: white_pawns.count(col) for col in white_pawns}
         bp_counts = {col: black_pawns.count(col) for col in black_pawns}
@@ -583,4 +1019,37 @@ class ChessAI:
     def _get_piece_name(self, piece_code):  
         """Helper to get full piece name from code (e.g., 'wp' -> 'Pawn')."""
         names = {'p': 'Pawn', 'n': 'Knight', 'b': 'Bishop', 'r': 'Rook', 'q': 'Queen', 'k': 'King'}
-        return names.get(piece_code[1], 'Unknown')
\ No newline at end of file
+        return names.get(piece_code[1], 'Unknown')
+
+
+def _lazy_smp_helper(snapshot, color, max_depth, max_time, table_name, tt_size_mb, generation, stop_name,
+                     helper_index):
+    # Runs in a worker process: search the same root into the shared table until told to stop.
+    ai = ChessAI(GameState.from_snapshot(snapshot), max_depth, color, tt_size_mb=tt_size_mb,
+                 shared_table_name=table_name)
+    ai.transposition_table.generation = generation
+    ai.helper_index = helper_index
+    ai.stop_signal = shared_memory.SharedMemory(name=stop_name)
+    try:
+        best_move = ai.iterative_deepening(max_time=max_time)
+        return ai.completed_depth, ai.best_score, best_move.move_id if best_move else 0
+    finally:
+        ai.stop_signal.close()
+        ai.transposition_table.close()
+
+
+def _search_root_move(snapshot, depth, alpha, beta, color, table_name, tt_size_mb, generation, stop_name, max_time):
+    # Runs in a worker process: snapshot is the position after one root move; the score is for the mover.
+    ai = ChessAI(GameState.from_snapshot(snapshot), depth, color, tt_size_mb=tt_size_mb,
+                 shared_table_name=table_name)
+    ai.transposition_table.generation = generation
+    ai.stop_signal = shared_memory.SharedMemory(name=stop_name)
+    if max_time:
+        ai.start_time = time.time()
+        ai.max_time = max_time
+    try:
+        score = -ai.alphabeta(depth - 1, -beta, -alpha, 1)
+        return score, ai.nodes_visited, ai.timeout_occurred
+    finally:
+        ai.stop_signal.close()
+        ai.transposition_table.close()
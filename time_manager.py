@@ -0,0 +1,71 @@
+# Seconds kept back on every move for GUI and process overhead.
+MOVE_OVERHEAD = 0.05
+# Expected moves left in the game with a full board and with bare kings.
+OPENING_MOVES_TO_GO = 40
+ENDGAME_MOVES_TO_GO = 15
+INCREMENT_SHARE = 0.75
+HARD_LIMIT_FACTOR = 4.0
+MAX_CLOCK_SHARE = 0.3
+# Soft-limit scaling when the best move keeps changing or keeps standing between depths.
+MIN_STABILITY = 0.5
+MAX_STABILITY = 2.0
+# Assumed growth of each depth over the last one until two depths have been timed.
+DEFAULT_DEPTH_GROWTH = 3.0
+
+
+class TimeManager:
+    """Per-move time limits for iterative deepening.
+
+    No new depth is started past the soft limit, or when the previous depths
+    suggest it cannot finish before the hard limit, at which point the search is
+    aborted. With a clock the soft limit also shrinks while the best move stays
+    the same from depth to depth and grows while it keeps changing.
+    """
+
+    def __init__(self, soft_limit, hard_limit, adaptive=True):
+        self.base_soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.adaptive = adaptive
+        self.stability = 1.0
+        self.best_move_id = None
+        self.iteration_times = []
+
+    @classmethod
+    def fixed(cls, max_time):
+        # The old fixed budget: stop deepening at 95% of it, abort at 100%.
+        return cls(max_time * 0.95, max_time, adaptive=False)
+
+    @classmethod
+    def from_clock(cls, remaining, increment=0.0, piece_count=32, moves_to_go=None):
+        remaining = max(remaining - MOVE_OVERHEAD, 0.01)
+        if moves_to_go is None:
+            moves_to_go = ENDGAME_MOVES_TO_GO + \
+                (OPENING_MOVES_TO_GO - ENDGAME_MOVES_TO_GO) * min(piece_count, 32) / 32
+        base = remaining / max(moves_to_go, 1) + increment * INCREMENT_SHARE
+        hard_limit = min(base * HARD_LIMIT_FACTOR, remaining * MAX_CLOCK_SHARE)
+        return cls(min(base, hard_limit), hard_limit)
+
+    @property
+    def soft_limit(self):
+        return min(self.base_soft_limit * self.stability, self.hard_limit)
+
+    def record_iteration(self, best_move, duration):
+        if self.adaptive and self.best_move_id is not None:
+            if best_move.move_id == self.best_move_id:
+                self.stability = max(MIN_STABILITY, self.stability * 0.85)
+            else:
+                self.stability = min(MAX_STABILITY, max(self.stability, 1.0) * 1.5)
+        self.best_move_id = best_move.move_id
+        self.iteration_times.append(duration)
+
+    def should_start_iteration(self, elapsed):
+        if elapsed >= self.soft_limit:
+            return False
+        if self.iteration_times:
+            last = self.iteration_times[-1]
+            growth = DEFAULT_DEPTH_GROWTH
+            if len(self.iteration_times) > 1 and self.iteration_times[-2] > 0:
+                growth = min(max(last / self.iteration_times[-2], 1.5), 10.0)
+            if elapsed + last * growth > self.hard_limit:
+                return False
+        return True
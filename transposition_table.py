@@ -0,0 +1,103 @@
+import struct
+from array import array
+from multiprocessing import shared_memory
+
+# Each entry is three 8-byte slots: the full Zobrist key, the raw bits of the float score, and a
+# packed word holding move_id (bits 0-15), flag (16-17), depth (18-25) and search generation (26-33).
+ENTRY_BYTES = 24
+BUCKET_SIZE = 2
+MAX_GENERATION = 0xFF
+_FLOAT = struct.Struct('=d')
+_WORD = struct.Struct('=Q')
+
+
+class TranspositionTable:
+    """Fixed-size hash table of search results, preallocated as flat arrays.
+
+    Positions map to a two-entry bucket. The first entry is depth-preferred: it is
+    only overwritten by a search at least as deep, or once it is left over from an
+    older search. The second entry always takes the newest result.
+
+    With shared=True the arrays live in a multiprocessing.shared_memory block that
+    other processes open by passing its name. Writers do not lock; an entry's key
+    slot holds the key XORed with its score bits and packed word, so a probe that
+    sees slots from two different writes does not match.
+    """
+
+    def __init__(self, size_mb=16, shared=False, name=None):
+        self.size_mb = size_mb
+        entries = max(BUCKET_SIZE, int(size_mb * 1024 * 1024) // ENTRY_BYTES)
+        self.bucket_count = entries // BUCKET_SIZE
+        self.generation = 0
+        self.shared_memory = None
+        if shared or name is not None:
+            self.shared_memory = shared_memory.SharedMemory(name=name, create=name is None,
+                                                            size=self.bucket_count * BUCKET_SIZE * ENTRY_BYTES)
+            self._map_shared()
+        else:
+            self._allocate(self.bucket_count * BUCKET_SIZE)
+
+    @property
+    def name(self):
+        return self.shared_memory.name if self.shared_memory is not None else None
+
+    def _allocate(self, entries):
+        self.keys = array('Q', bytes(8 * entries))
+        self.scores = array('Q', bytes(8 * entries))
+        self.data = array('Q', bytes(8 * entries))
+
+    def _map_shared(self):
+        size = self.bucket_count * BUCKET_SIZE * 8
+        buffer = self.shared_memory.buf
+        self.keys = buffer[:size].cast('Q')
+        self.scores = buffer[size:2 * size].cast('Q')
+        self.data = buffer[2 * size:3 * size].cast('Q')
+
+    def close(self, unlink=False):
+        """Releases a shared table; the process that created it should pass unlink=True."""
+        if self.shared_memory is None:
+            return
+        for view in (self.keys, self.scores, self.data):
+            view.release()
+        self.shared_memory.close()
+        if unlink:
+            self.shared_memory.unlink()
+        self.shared_memory = None
+
+    def new_search(self):
+        self.generation = (self.generation + 1) & MAX_GENERATION
+
+    def probe(self, key):
+        index = (key % self.bucket_count) * BUCKET_SIZE
+        for index in (index, index + 1):
+            # Read every slot once before checking, so the values checked are the values returned.
+            score_bits = self.scores[index]
+            packed = self.data[index]
+            if self.keys[index] ^ score_bits ^ packed == key:
+                score = _FLOAT.unpack(_WORD.pack(score_bits))[0]
+                return score, (packed >> 18) & 0xFF, (packed >> 16) & 0x3, packed & 0xFFFF
+        return None
+
+    def store(self, key, score, depth, flag, move_id):
+        index = (key % self.bucket_count) * BUCKET_SIZE
+        keys = self.keys
+        scores = self.scores
+        data = self.data
+        if keys[index] ^ scores[index] ^ data[index] != key:
+            stored = data[index]
+            stale = (stored >> 26) & MAX_GENERATION != self.generation
+            if stored != 0 and not stale and depth < (stored >> 18) & 0xFF:
+                index += 1
+        # Keep the old best move when the new result has none to offer.
+        if not move_id and keys[index] ^ scores[index] ^ data[index] == key:
+            move_id = data[index] & 0xFFFF
+        packed = move_id | flag << 16 | min(max(depth, 0), 0xFF) << 18 | self.generation << 26
+        score_bits = _WORD.unpack(_FLOAT.pack(score))[0]
+        keys[index] = key ^ score_bits ^ packed
+        scores[index] = score_bits
+        data[index] = packed
+
+    def usage(self):
+        """Fraction of entries written during the current search."""
+        current = sum(1 for word in self.data if (word >> 26) & MAX_GENERATION == self.generation and word)
+        return current / len(self.data)